@@ -0,0 +1,3 @@
+'''
+Benchmarks of the deck builds, see bench.run.
+'''
@@ -0,0 +1,373 @@
+'''
+Benchmark the stages of the deck builds on recorded and synthetic data.
+
+    python -m bench.run --sizes 0 10000 100000 --only jp.
+
+Size 0 runs every stage on the unscaled data: the recorded query results of
+the JP deck and the synthetic states of the US deck, which has no recorded
+results. Other sizes scale them up to about that many prefectures or states
+(see bench.synthetic). Each stage is timed (best of `--repeat`) and its peak
+memory traced in one more run. The results are appended to a history with the
+commit they were measured at and compared to the last measurement at another
+commit.
+'''
+
+import argparse
+import copy
+import json
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from collections import namedtuple
+from functools import partial
+from pathlib import Path
+
+from core.wikidata import configure_cache, configure_endpoint
+
+ROOT = Path(__file__).resolve().parent.parent
+HISTORY = ROOT / '.cache' / 'bench' / 'history.jsonl'
+
+# `setup` prepares the arguments of `func` from the data of the deck, untimed
+Benchmark = namedtuple('Benchmark', 'name, setup, func')
+
+
+################################################################################
+class ResultCache():
+    '''
+    Answer every query of a WDQuery with the same result.
+    '''
+
+    def __init__(self, result):
+        self.result = result
+
+    def fetch(self, query, endpoint=None):  # pylint: disable=unused-argument
+        '''The result, whatever the query.'''
+
+        return self.result
+
+
+################################################################################
+def jp_data(size, workdir):
+    '''
+    The query results of the Japan deck scaled to `size` prefectures, with the
+    intermediate results of the stages.
+    '''
+
+    # pylint: disable=import-outside-toplevel
+    from core.wikidata import WDQuery, fold_bindings
+    from jp import make_deck_jp as jp
+    from bench.synthetic import JP_SCALED, scale_results
+
+    results = {name: WDQuery((jp.HERE / 'sparql' / f'{name}.rq').read_text()).get_json()
+               for name in ('regions', 'prefectures', 'capitals')}
+
+    if size:
+        results = scale_results(results, size, 'prefectures', JP_SCALED)
+
+    data = {'results': results}
+    data['items'] = {name: fold_bindings(result) for name, result in results.items()}
+
+    data['prefectures_stats'] = jp.process_prefectures(
+        copy.deepcopy(data['items']['prefectures']))
+    data['regions'] = jp.process_regions(
+        copy.deepcopy(data['items']['regions']), data['prefectures_stats'])
+    data['prefectures'] = jp.index_prefectures(data['prefectures_stats'], data['regions'])
+
+    data['names'] = list(data['items']['prefectures']) + list(data['items']['capitals'])
+    # The synthetic prefectures are not on the map
+    data['notes'] = jp.export_prefectures(data['prefectures'], workdir, check=False)
+
+    return data
+
+
+################################################################################
+def jp_benchmarks(workdir):
+    '''
+    The stages of the Japan deck.
+    '''
+
+    # pylint: disable=import-outside-toplevel
+    from core.apkg import PackageWriter
+    from core.ranking import rank_items
+    from core.tables import Table
+    from core.wikidata import fold_bindings
+    from jp import make_deck_jp as jp
+    from jp.models_jp import PREF_DECK, PREF_MODEL
+
+    def names(values):
+        for value in values:
+            jp.strip_to_name(value)
+            jp.as_map_id(value)
+            jp.as_romaji(value)
+
+    def package(notes):
+        with PackageWriter(str(Path(workdir, 'bench.apkg')), PREF_DECK) as package_writer:
+            package_writer.add_table(PREF_MODEL, notes, tags='tags', guid='index')
+
+    def tables(items):
+        Table.from_items(items).save(Path(workdir, 'tables', 'prefectures'))
+        Table.load(Path(workdir, 'tables', 'prefectures'))['stats_population'].sum()
+
+    return [
+        Benchmark('fold_bindings',
+                  lambda data: (data['results']['prefectures'],), fold_bindings),
+        Benchmark('names', lambda data: (data['names'],), names),
+        Benchmark('process_prefectures',
+                  lambda data: (copy.deepcopy(data['items']['prefectures']),),
+                  jp.process_prefectures),
+        Benchmark('rank_items',
+                  lambda data: ([dict(item) for item in data['prefectures_stats'].values()],),
+                  partial(rank_items, columns=['stats_population', 'stats_area'])),
+        Benchmark('process_regions',
+                  lambda data: (copy.deepcopy(data['items']['regions']),
+                                data['prefectures_stats']),
+                  jp.process_regions),
+        Benchmark('index_prefectures',
+                  lambda data: (data['prefectures_stats'], data['regions']),
+                  jp.index_prefectures),
+        Benchmark('fix_urls', lambda data: (copy.deepcopy(data['prefectures']),),
+                  jp.fix_urls),
+        Benchmark('tables', lambda data: (data['prefectures'],), tables),
+        Benchmark('export_prefectures', lambda data: (data['prefectures'], workdir),
+                  partial(jp.export_prefectures, check=False)),
+        Benchmark('package', lambda data: (data['notes'],), package),
+    ]
+
+
+################################################################################
+def us_data(size, workdir):  # pylint: disable=unused-argument
+    '''
+    A synthetic states result of the US deck scaled to `size` states, with the
+    intermediate results of the stages. Size 0 is the synthetic result as is.
+    '''
+
+    # pylint: disable=import-outside-toplevel
+    from core.wikidata import WDQuery
+    from us import create_anki as us
+    from us.data import US_REGIONS
+    from bench.synthetic import US_SCALED, copies_for, scale_regions, scale_result, us_states
+
+    result = us_states(US_REGIONS)
+    copies = copies_for(result, size) if size else 1
+
+    data = {
+        'result': scale_result(result, copies, US_SCALED['states']),
+        'regions': scale_regions(US_REGIONS, copies),
+    }
+
+    data['wd_df'] = WDQuery('', cache=ResultCache(data['result'])).get_df()
+    data['states'] = us.prepare_states(data['wd_df']).assign(
+        pngpath_flag=None, pngpath_seal=None, img_flag='', img_seal='')
+    data['regions_df'] = us.prepare_regions(data['states'], regions=data['regions'])
+
+    check_us_notes(data['result'], data['regions_df'])
+
+    return data
+
+
+################################################################################
+def check_us_notes(result, wd_df):
+    '''
+    Make sure the state notes show the query values as the deck always did,
+    before the columns were typed: as the strings Wikidata returns.
+    '''
+
+    # pylint: disable=import-outside-toplevel
+    from core.apkg import table_rows
+    from us.models import STATE_FIELDS, STATE_MODEL
+
+    rows = table_rows(STATE_MODEL, wd_df, STATE_FIELDS, guid='name_en')
+    notes = {guid: dict(zip(STATE_FIELDS, values)) for values, _, guid in rows}
+
+    for binding in result['results']['bindings']:
+        note = notes[binding['name_en']['value']]
+
+        for field in ('capital', 'stats_population_date', 'url_official', 'url_wikipedia'):
+            if field in binding and note[field] != binding[field]['value']:
+                raise AssertionError(f'{field} of {note["name_en"]} changed: '
+                                     f'{binding[field]["value"]!r} became {note[field]!r}')
+
+
+################################################################################
+def us_benchmarks(workdir):
+    '''
+    The stages of the US deck, without the images.
+    '''
+
+    # pylint: disable=import-outside-toplevel
+    from core.wikidata import WDQuery
+    from us import create_anki as us
+
+    return [
+        Benchmark('get_df', lambda data: (data['result'],),
+                  lambda result: WDQuery('', cache=ResultCache(result)).get_df()),
+        Benchmark('prepare_states', lambda data: (data['wd_df'],), us.prepare_states),
+        Benchmark('prepare_regions', lambda data: (data['states'], data['regions']),
+                  lambda states, regions: us.prepare_regions(states, regions=regions)),
+        Benchmark('package',
+                  lambda data: (data['regions_df'].copy(),
+                                str(Path(workdir, 'bench_us.apkg'))),
+                  partial(us.prepare_anki, check=False)),
+    ]
+
+
+# The data, the benchmarks and what size 0 runs on of every deck
+DECKS = {
+    'jp': (jp_data, jp_benchmarks, 'recorded'),
+    'us': (us_data, us_benchmarks, 'synthetic'),
+}
+
+
+################################################################################
+def measure(benchmark, data, repeat=3):
+    '''
+    The best time in seconds of `repeat` runs and the peak of traced memory.
+    '''
+
+    times = []
+
+    for _ in range(repeat):
+        args = benchmark.setup(data)
+
+        start = time.perf_counter()
+        benchmark.func(*args)
+        times.append(time.perf_counter() - start)
+
+    args = benchmark.setup(data)
+
+    tracemalloc.start()
+    try:
+        benchmark.func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+################################################################################
+def current_commit():
+    '''
+    The commit the benchmarks run at, marked if the tree has changes.
+    '''
+
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True,
+                              text=True, check=False).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+
+    if git('status', '--porcelain', '--untracked-files=no'):
+        commit += '+dirty'
+
+    return commit
+
+
+################################################################################
+def load_history(path=HISTORY):
+    '''
+    All earlier measurements, oldest first.
+    '''
+
+    try:
+        lines = Path(path).read_text().splitlines()
+    except FileNotFoundError:
+        return []
+
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+################################################################################
+def previous(history, record):
+    '''
+    The last measurement of the same benchmark and size at another commit.
+    '''
+
+    for old in reversed(history):
+        if ((old['bench'], old['size']) == (record['bench'], record['size'])
+                and old['commit'] != record['commit']):
+            return old
+
+    return None
+
+
+################################################################################
+def main():
+    '''Benchmark the deck build stages on recorded and synthetic data.'''
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+
+    parser.add_argument('--decks', nargs='+', choices=DECKS, default=list(DECKS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[0, 10_000],
+                        help='entities per deck, 0 for the unscaled (recorded or synthetic) data')
+    parser.add_argument('--only', nargs='+', default=[],
+                        help='run the benchmarks whose name contains one of these')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per benchmark, the best counts')
+    parser.add_argument('--history', type=Path, default=HISTORY,
+                        help='append the results to this JSON lines file')
+    parser.add_argument('--no-save', action='store_true',
+                        help='only compare, do not add to the history')
+    parser.add_argument('--endpoint',
+                        help='answer uncached queries from here, e.g. replay:<dir>')
+
+    args = parser.parse_args()
+
+    configure_cache(offline=args.endpoint is None)
+    configure_endpoint(args.endpoint)
+
+    history = load_history(args.history)
+    commit = current_commit()
+    records = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind in ('json', 'csv'):
+            Path(workdir, kind).mkdir()
+
+        for deck in args.decks:
+            make_data, make_benchmarks, unscaled = DECKS[deck]
+
+            benchmarks = [benchmark for benchmark in make_benchmarks(workdir)
+                          if not args.only or any(pattern in f'{deck}.{benchmark.name}'
+                                                  for pattern in args.only)]
+
+            if not benchmarks:
+                continue
+
+            for size in args.sizes:
+                data = make_data(size, workdir)
+
+                for benchmark in benchmarks:
+                    seconds, peak = measure(benchmark, data, args.repeat)
+
+                    record = {
+                        'bench': f'{deck}.{benchmark.name}',
+                        'size': size,
+                        'seconds': round(seconds, 6),
+                        'peak_bytes': peak,
+                        'commit': commit,
+                        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    }
+                    records.append(record)
+
+                    old = previous(history, record)
+                    change = (f'  {seconds / old["seconds"] - 1:+.0%} vs {old["commit"]}'
+                              if old and old['seconds'] else '')
+
+                    print(f'{record["bench"]:<28} {size or unscaled:>9} '
+                          f'{seconds * 1000:>10.2f} ms {peak / 2**20:>9.1f} MB{change}',
+                          flush=True)
+
+    if not args.no_save:
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+
+        with args.history.open('a') as outfile:
+            for record in records:
+                outfile.write(json.dumps(record) + '\n')
+
+
+################################################################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Scale recorded query results up to synthetic datasets of any size.
+
+The bindings are repeated with a numbered suffix on the names that identify
+and link the entities, so the copies stay consistent across the queries of a
+deck: a copied prefecture belongs to the original region and is listed by it,
+and a copied capital lies in the copied prefecture. Copy 0 is the recording.
+'''
+
+import copy
+import math
+import zlib
+
+from datetime import date, timedelta
+
+from core.wikidata import XSD
+
+# The columns that name an entity of the scaled unit, per query
+JP_SCALED = {
+    'regions': ('prefecture_en',),
+    'prefectures': ('name_en', 'name_kanji', 'name_kana'),
+    'capitals': ('name_en', 'name_kanji', 'name_kana', 'in_prefecture'),
+}
+US_SCALED = {
+    'states': ('name_en', 'capital'),
+}
+
+
+################################################################################
+def copies_for(result, size):
+    '''
+    The number of copies of a result with one row per unit to reach `size` units.
+    '''
+
+    return max(1, math.ceil(size / max(1, len(result['results']['bindings']))))
+
+
+################################################################################
+def scale_result(result, copies, columns):
+    '''
+    Repeat the bindings of a result, suffixing the values in `columns`.
+    '''
+
+    bindings = []
+
+    for idx in range(copies):
+        for binding in result['results']['bindings']:
+            binding = copy.deepcopy(binding)
+
+            for column in columns:
+                if idx and column in binding:
+                    binding[column]['value'] = f'{binding[column]["value"]} {idx}'
+
+            bindings.append(binding)
+
+    return {'head': copy.deepcopy(result['head']), 'results': {'bindings': bindings}}
+
+
+################################################################################
+def scale_results(results, size, unit, scaled):
+    '''
+    Scale the results of all queries of a deck so that the `unit` query has
+    about `size` rows, `scaled` names the columns to suffix per query.
+    '''
+
+    copies = copies_for(results[unit], size)
+
+    return {name: scale_result(result, copies, scaled.get(name, ()))
+            for name, result in results.items()}
+
+
+################################################################################
+def literal(value, datatype=None, lang=None):
+    '''
+    A literal binding of a SPARQL JSON result.
+    '''
+
+    binding = {'type': 'literal', 'value': str(value)}
+
+    if datatype:
+        binding['datatype'] = XSD + datatype
+    if lang:
+        binding['xml:lang'] = lang
+
+    return binding
+
+
+################################################################################
+def us_states(regions):
+    '''
+    A states result like us/sparql/states.rq returns, for the states of the
+    regions in us/data.py, with made-up but stable statistics.
+    '''
+
+    bindings = []
+
+    for region in sorted(regions):
+        for name in region.reg_state_list:
+            seed = zlib.crc32(name.encode('utf-8'))
+            slug = name.replace(' ', '_')
+
+            bindings.append({
+                'name_en': literal(name, lang='en'),
+                'capital': literal(f'Capital of {name}', lang='en'),
+                'stats_population': literal(500_000 + seed % 39_000_000, 'decimal'),
+                'stats_population_date': literal(
+                    (date(2010, 1, 1) + timedelta(days=seed % 3650)).isoformat()
+                    + 'T00:00:00Z', 'dateTime'),
+                'stats_area': literal(f'{1_000 + seed % 1_700_000 / 1.7:.2f}', 'decimal'),
+                'url_official': {'type': 'uri', 'value': f'https://www.{slug.lower()}.gov/'},
+                'url_wikipedia': {'type': 'uri',
+                                  'value': f'https://en.wikipedia.org/wiki/{slug}'},
+                'svg_flag': {'type': 'uri', 'value': f'https://example.org/Flag_of_{slug}.svg'},
+                'svg_seal': {'type': 'uri', 'value': f'https://example.org/Seal_of_{slug}.svg'},
+            })
+
+    return {
+        'head': {'vars': ['name_en', 'capital', 'stats_population', 'stats_population_date',
+                          'stats_area', 'url_official', 'url_wikipedia',
+                          'svg_flag', 'svg_symbol', 'svg_seal']},
+        'results': {'bindings': bindings},
+    }
+
+
+################################################################################
+def scale_regions(regions, copies):
+    '''
+    The regions of us/data.py listing the suffixed copies of their states too.
+    '''
+
+    return {region._replace(reg_state_list=tuple(
+        f'{name} {idx}' if idx else name
+        for idx in range(copies) for name in region.reg_state_list))
+            for region in regions}
@@ -0,0 +1,245 @@
+'''
+Write Anki packages note batch by note batch.
+'''
+
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from genanki import Note
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+from genanki.util import guid_for
+
+from core import profile
+
+
+################################################################################
+class PackageWriter():
+    '''
+    Stream notes and media into an .apkg file.
+
+    The notes of a table are inserted into the collection database in batches
+    of `batch_size` and media files are copied into the archive as soon as they
+    are added, so no note objects pile up in memory. Notes already added to
+    `deck` the genanki way are written as well.
+
+        with PackageWriter('output.apkg', DECK) as package:
+            package.add_table(MODEL, table, tags='tags', guid='index')
+            package.add_media(paths)
+    '''
+
+    ############################################################################
+    def __init__(self, path, deck, timestamp=None, batch_size=1000):
+        self.path = path
+        self.deck = deck
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.batch_size = batch_size
+
+        self.models = {}
+        self.media = {}
+
+        self.ids = itertools.count(int(self.timestamp * 1000))
+
+        self.dbpath = None
+        self.conn = None
+        self.archive = None
+
+    ############################################################################
+    def __enter__(self):
+        dbfile, self.dbpath = tempfile.mkstemp(suffix='.anki2')
+        os.close(dbfile)
+
+        self.conn = sqlite3.connect(self.dbpath)
+        self.conn.executescript(APKG_SCHEMA)
+        self.conn.executescript(APKG_COL)
+
+        self.archive = zipfile.ZipFile(self.path, 'w')
+
+        return self
+
+    ############################################################################
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.conn.close()
+            self.archive.close()
+            os.remove(self.dbpath)
+
+    ############################################################################
+    def add_media(self, paths):
+        '''
+        Copy media files into the package, each file is added once.
+        '''
+
+        with profile.span('media'):
+            for path in paths:
+                if str(path) in self.media:
+                    continue
+
+                self.media[str(path)] = len(self.media)
+                self.archive.write(path, str(self.media[str(path)]))
+
+                profile.count('package.media_files')
+
+    ############################################################################
+    def add_table(self, model, table, fields=None, tags=(), guid=None, only=None):
+        '''
+        Insert a note of `model` for every row of a columnar table.
+
+        See table_rows() for the arguments. With `only`, a set of GUIDs, the
+        other notes are left out (e.g. for a package of updates).
+        '''
+
+        self.models[model.model_id] = model
+
+        rows = table_rows(model, table, fields, tags, guid)
+
+        if only is not None:
+            rows = (row for row in rows if row[2] in only)
+
+        with profile.span('notes'):
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+
+                if not batch:
+                    break
+
+                self.write_batch(model, batch)
+                profile.count('package.notes', len(batch))
+
+    ############################################################################
+    def write_batch(self, model, batch):
+        '''
+        Insert a batch of (fields, tags, guid) rows with one statement per table.
+        '''
+
+        timestamp = int(self.timestamp)
+        notes, cards = [], []
+
+        for values, tags, guid in batch:
+            note_id = next(self.ids)
+
+            notes.append((
+                note_id,
+                guid,
+                model.model_id,
+                timestamp,
+                -1,
+                ' ' + ' '.join(tags) + ' ',
+                '\x1f'.join(values),
+                values[model.sort_field_index],
+                0,
+                0,
+                '',
+            ))
+
+            for card_ord in self.card_ords(model, values):
+                cards.append((next(self.ids), note_id, self.deck.deck_id, card_ord,
+                              timestamp, -1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ''))
+
+        self.conn.executemany(
+            'INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?);', notes)
+        self.conn.executemany(
+            'INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);', cards)
+
+    ############################################################################
+    @staticmethod
+    def card_ords(model, values):
+        '''
+        The templates of the model that produce a card for these field values.
+        '''
+
+        if model.model_type != model.FRONT_BACK:
+            return [card.ord for card in Note(model=model, fields=values).cards]
+
+        return [card_ord for card_ord, any_or_all, required in model._req  # pylint: disable=protected-access
+                if {'any': any, 'all': all}[any_or_all](values[idx] for idx in required)]
+
+    ############################################################################
+    @profile.profiled('finish')
+    def finish(self):
+        '''
+        Register the deck and models and put the collection into the package.
+        '''
+
+        cursor = self.conn.cursor()
+
+        for note in self.deck.notes:
+            self.models[note.model.model_id] = note.model
+
+        decks = json.loads(cursor.execute('SELECT decks FROM col').fetchone()[0])
+        decks[str(self.deck.deck_id)] = self.deck.to_json()
+
+        models = json.loads(cursor.execute('SELECT models FROM col').fetchone()[0])
+        models.update({model_id: model.to_json(self.timestamp, self.deck.deck_id)
+                       for model_id, model in self.models.items()})
+
+        cursor.execute('UPDATE col SET decks = ?, models = ?',
+                       (json.dumps(decks), json.dumps(models)))
+
+        for note in self.deck.notes:
+            note.write_to_db(cursor, self.timestamp, self.deck.deck_id, self.ids)
+
+        self.conn.commit()
+
+        self.archive.write(self.dbpath, 'collection.anki2')
+        self.archive.writestr('media', json.dumps(
+            {idx: os.path.basename(path) for path, idx in self.media.items()}))
+
+
+################################################################################
+def table_rows(model, table, fields=None, tags=(), guid=None):
+    '''
+    The (field values, tags, GUID) of the notes of `model` in a columnar table,
+    the values and GUIDs as strings.
+
+    `table` maps column names to sequences of equal length (a dict of lists
+    or a DataFrame). `fields` names the column for each field of the model
+    and defaults to the field names. `tags` and `guid` name a column or give
+    one value for all notes, by default the GUID is derived from the fields
+    like genanki does.
+    '''
+
+    fields = fields or [field['name'] for field in model.fields]
+
+    if len(fields) != len(model.fields):
+        raise ValueError(f'{model.name} has {len(model.fields)} fields, '
+                         f'but {len(fields)} columns were given')
+
+    tag_values = table[tags] if isinstance(tags, str) else itertools.repeat(tags)
+    guids = table[guid] if isinstance(guid, str) else itertools.repeat(guid)
+
+    for row, tags, guid in zip(zip(*(table[column] for column in fields)), tag_values, guids):
+        values = [str(value) for value in row]
+
+        yield values, tags, guid_for(*values) if guid is None else str(guid)
+
+
+################################################################################
+def item_table(items, columns):
+    '''
+    Columnar table of some columns of dict items, e.g. for add_table().
+    '''
+
+    items = list(items)
+
+    return {column: [item[column] for item in items] for column in columns}
+
+
+################################################################################
+def select_rows(table, keep):
+    '''
+    The rows of a columnar table of item_table() for which `keep` is true.
+    '''
+
+    keep = list(keep)
+
+    return {column: [value for value, kept in zip(values, keep) if kept]
+            for column, values in table.items()}
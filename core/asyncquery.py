@@ -0,0 +1,75 @@
+'''
+Issue the queries of a deck concurrently from asyncio.
+'''
+
+import asyncio
+import weakref
+
+from core.wikidata import WDQuery
+
+
+################################################################################
+class QueryRunner():
+    '''
+    Run queries concurrently, at most `max_in_flight` at once.
+
+    Every query goes through WDQuery (cache, chunking, retries) on a worker
+    thread of the event loop, the live queries share the pooled session of
+    the configured endpoint. `options` are passed on to every WDQuery.
+    '''
+
+    ############################################################################
+    def __init__(self, max_in_flight=8, **options):
+        self.max_in_flight = max_in_flight
+        self.options = options
+
+        # Gone with their loop, e.g. after every asyncio.run()
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    ############################################################################
+    def semaphore(self):
+        '''
+        The semaphore bounding the queries on the running event loop.
+        '''
+
+        loop = asyncio.get_running_loop()
+
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+
+        return self._semaphores[loop]
+
+    ############################################################################
+    async def run(self, query, method='get_json', *args, **options):
+        '''
+        Await the result of a WDQuery method, e.g. get_json, get_items or get_df.
+        '''
+
+        wd_query = WDQuery(query, **{**self.options, **options})
+
+        async with self.semaphore():
+            return await asyncio.to_thread(getattr(wd_query, method), *args)
+
+    ############################################################################
+    async def get_json(self, query, **options):
+        '''
+        Await the raw JSON result of a query.
+        '''
+
+        return await self.run(query, 'get_json', **options)
+
+    ############################################################################
+    async def get_items(self, query, key='name_en', **options):
+        '''
+        Await the result of a query as dict per value of `key`.
+        '''
+
+        return await self.run(query, 'get_items', key, **options)
+
+    ############################################################################
+    async def get_df(self, query, **options):
+        '''
+        Await the result of a query as DataFrame.
+        '''
+
+        return await self.run(query, 'get_df', **options)
@@ -0,0 +1,205 @@
+'''
+Remember what went into the last package of a deck to rebuild only changes.
+
+The manifest next to a package stores a content hash of every note (keyed by
+its GUID), media file and model. A build compares its notes against it: if
+nothing changed the package is left alone, otherwise the changed notes and
+media can also be written to a small package of updates, which Anki merges
+into the existing deck by GUID on import.
+'''
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+
+from core.apkg import PackageWriter, table_rows
+
+
+################################################################################
+def content_hash(*parts):
+    '''
+    Short hash of some JSON serializable values.
+    '''
+
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True,
+                                     default=str).encode('utf-8')).hexdigest()[:24]
+
+
+################################################################################
+def file_hash(path):
+    '''
+    Short hash of the bytes of a file.
+    '''
+
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()[:24]
+
+
+################################################################################
+def write_if_changed(path, text):
+    '''
+    Write a text file unless it already has this content, return if it was.
+    '''
+
+    path = Path(path)
+
+    try:
+        if path.read_text() == text:
+            return False
+    except (OSError, ValueError):
+        pass
+
+    path.write_text(text)
+
+    return True
+
+
+################################################################################
+class BuildState():
+    '''
+    The hashes of the notes, media and models of a package.
+
+        state = BuildState('output.apkg')
+        state.add_table(MODEL, table, tags='tags', guid='index')
+        state.add_media(paths)
+
+        if not state.changed():
+            ...
+    '''
+
+    ############################################################################
+    def __init__(self, package, path=None):
+        self.package = Path(package)
+        self.path = Path(path) if path else self.package.with_suffix('.state.json')
+
+        try:
+            self.previous = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.previous = None
+
+        self.current = {'models': {}, 'notes': {}, 'media': {}}
+        self.tables = []
+
+    ############################################################################
+    def add_table(self, model, table, fields=None, tags=(), guid=None):
+        '''
+        Hash the notes of a table, see core.apkg.table_rows() for the arguments.
+        '''
+
+        self.tables.append((model, table, fields, tags, guid))
+
+        self.current['models'][str(model.model_id)] = content_hash(
+            model.name, model.fields, model.templates, model.css, model.model_type)
+
+        for values, note_tags, note_guid in table_rows(model, table, fields, tags, guid):
+            self.current['notes'][note_guid] = content_hash(
+                model.model_id, values, list(note_tags))
+
+    ############################################################################
+    def add_media(self, paths):
+        '''
+        Hash the media files.
+        '''
+
+        for path in paths:
+            self.current['media'][str(path)] = file_hash(path)
+
+    ############################################################################
+    def changed_notes(self):
+        '''
+        The GUIDs of the notes that are new or differ from the last package.
+        '''
+
+        before = (self.previous or {}).get('notes', {})
+
+        return {guid for guid, digest in self.current['notes'].items()
+                if before.get(guid) != digest}
+
+    ############################################################################
+    def removed_notes(self):
+        '''
+        The GUIDs of the notes that were in the last package only.
+        '''
+
+        return set((self.previous or {}).get('notes', {})) - set(self.current['notes'])
+
+    ############################################################################
+    def changed_media(self):
+        '''
+        The media files that are new or differ from the last package.
+        '''
+
+        before = (self.previous or {}).get('media', {})
+
+        return [path for path, digest in self.current['media'].items()
+                if before.get(path) != digest]
+
+    ############################################################################
+    def changed(self):
+        '''
+        Whether the package has to be written again.
+        '''
+
+        return (self.previous is None or not self.package.is_file()
+                or {key: self.previous.get(key) for key in self.current} != self.current)
+
+    ############################################################################
+    def write(self, deck, path=None, only=None, media=None):
+        '''
+        Write the tables and media to a package, by default the full one.
+
+        `only` (GUIDs) and `media` restrict the package, e.g. to the changes.
+        '''
+
+        with PackageWriter(str(path or self.package), deck) as package_writer:
+            package_writer.add_media(self.current['media'] if media is None else media)
+
+            for model, table, fields, tags, guid in self.tables:
+                package_writer.add_table(model, table, fields, tags, guid, only=only)
+
+    ############################################################################
+    def save(self):
+        '''
+        Store the manifest for the next build.
+        '''
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmppath = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        tmppath.write_text(json.dumps(self.current, indent=1, sort_keys=True))
+        os.replace(tmppath, self.path)
+
+
+################################################################################
+def write_package(package, deck, tables, media, incremental=False):
+    '''
+    Write the package of a deck with its tables of notes and media files.
+
+    `tables` are (model, table, fields, tags, guid) as for add_table(). With
+    `incremental` the package is only written if something changed since the
+    last build, and the new or changed notes and media also go into an
+    `<name>.update.apkg` next to it. Return the changed and removed GUIDs.
+    '''
+
+    state = BuildState(package)
+
+    for model, table, fields, tags, guid in tables:
+        state.add_table(model, table, fields, tags, guid)
+
+    state.add_media(media)
+
+    changed, removed = state.changed_notes(), state.removed_notes()
+
+    if incremental and not state.changed():
+        return changed, removed
+
+    state.write(deck)
+
+    if incremental and state.previous is not None:
+        state.write(deck, state.package.with_suffix('.update.apkg'),
+                    only=changed, media=state.changed_media())
+
+    state.save()
+
+    return changed, removed
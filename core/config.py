@@ -0,0 +1,92 @@
+'''
+Read the deck configurations, with the overrides of the selected variant.
+
+A deck JSON can list variants of the deck in its `Variants` section, each is
+merged over the rest of the configuration, e.g.
+
+    "Variants": {
+        "click": {"Deck": {"deck_id": 902012020020}, "Build": {"templates": ["Click on Map"]}}
+    }
+
+The models of a deck are built for the variant selected when they are first
+used, and kept per variant.
+'''
+
+import json
+import os
+
+from pathlib import Path
+
+# Read by the models when they are first used, e.g. in a worker of make_decks
+VARIANT_ENV = 'DECK_VARIANT'
+
+
+################################################################################
+def select_variant(name=None):
+    '''
+    Build the `name` variant of the decks from now on.
+    '''
+
+    if name:
+        os.environ[VARIANT_ENV] = name
+    else:
+        os.environ.pop(VARIANT_ENV, None)
+
+
+################################################################################
+def current_variant():
+    '''
+    The name of the selected variant, None for the deck as configured.
+    '''
+
+    return os.environ.get(VARIANT_ENV) or None
+
+
+################################################################################
+def merge_config(base, overrides):
+    '''
+    Recursively merge the overrides into a copy of a configuration.
+    '''
+
+    merged = dict(base)
+
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+
+    return merged
+
+
+################################################################################
+def load_config(path, variant=None):
+    '''
+    The configuration of a deck, for the selected variant if not given.
+    '''
+
+    conf = json.loads(Path(path).read_text())
+    variants = conf.pop('Variants', {})
+
+    variant = variant or current_variant()
+
+    if not variant:
+        return conf
+
+    if variant not in variants:
+        raise ValueError(f'{path} has no variant {variant}, '
+                         f'use one of {", ".join(variants) or "none"}')
+
+    return merge_config(conf, variants[variant])
+
+
+################################################################################
+def select_templates(templates, names=None):
+    '''
+    The card templates to build, all unless their names are given.
+    '''
+
+    if names is None:
+        return templates
+
+    return [template for template in templates if template['name'] in names]
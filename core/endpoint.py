@@ -0,0 +1,347 @@
+'''
+Backends that answer the SPARQL queries of the builders.
+
+Besides the live Wikidata service, responses can be recorded to fixture files
+and replayed from them, in-process or by a local stand-in server, so that
+builds and benchmarks run deterministically without network access.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from core import profile
+from core.session import make_session
+
+ENDPOINT_URL = 'https://query.wikidata.org/sparql'
+FIXTURE_DIR = Path(__file__).resolve().parent.parent / '.cache' / 'fixtures'
+
+# A status of 304 means the result did not change and is None
+Response = namedtuple('Response', 'status, result, etag, last_modified')
+
+# Worth another try: rate limits, overload and query timeouts (reported as 500)
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+
+################################################################################
+class MissingFixtureError(LookupError):
+    '''
+    Raised when a replayed query was never recorded.
+    '''
+
+
+################################################################################
+def normalize_query(query):
+    '''
+    Collapse all whitespace so that reformatting a query keeps its key.
+    '''
+
+    return ' '.join(query.split())
+
+
+################################################################################
+def query_key(query):
+    '''
+    The key of a query for caches and fixtures.
+    '''
+
+    return hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+
+
+################################################################################
+def is_transient(err):
+    '''
+    Whether a failed query may succeed when it is sent again.
+    '''
+
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and err.response.status_code in TRANSIENT_STATUS
+
+    return isinstance(err, (requests.ConnectionError, requests.Timeout,
+                            ConnectionError, TimeoutError))
+
+
+################################################################################
+class LiveEndpoint():
+    '''
+    Run the queries against a SPARQL service, by default Wikidata.
+
+    All queries share one keep-alive session, so concurrent queries reuse
+    the pooled connections instead of opening one each.
+    '''
+
+    ############################################################################
+    def __init__(self, url=ENDPOINT_URL, pool_size=8, timeout=90):
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._session = None
+        self._lock = threading.Lock()
+
+    ############################################################################
+    @property
+    def session(self):
+        '''
+        The pooled session, opened on first use.
+        '''
+
+        with self._lock:
+            if self._session is None:
+                self._session = make_session(self.pool_size)
+
+        return self._session
+
+    ############################################################################
+    def query(self, query, etag=None, last_modified=None):
+        '''
+        Run a query, conditional on the validators of an earlier response.
+        '''
+
+        headers = {'Accept': 'application/sparql-results+json'}
+
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        # POST, long queries (e.g. with a VALUES block) do not fit into a URL
+        response = self.session.post(self.url, data={'query': query},
+                                     headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304:
+            return Response(304, None, etag, last_modified)
+
+        response.raise_for_status()
+
+        profile.count('sparql.bytes_fetched', len(response.content))
+
+        return Response(200, response.json(),
+                        response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+
+################################################################################
+class FixtureStore():
+    '''
+    Recorded responses, one JSON file per query key.
+    '''
+
+    ############################################################################
+    def __init__(self, path=FIXTURE_DIR):
+        self.path = Path(path)
+
+    ############################################################################
+    def load(self, query):
+        '''
+        The recorded response for a query.
+        '''
+
+        try:
+            return json.loads((self.path / f'{query_key(query)}.json').read_text())
+        except FileNotFoundError:
+            raise MissingFixtureError(
+                f'No fixture for query {query_key(query)[:12]} in {self.path}') from None
+
+    ############################################################################
+    def save(self, query, result):
+        '''
+        Record the response for a query.
+        '''
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        body = json.dumps(result, ensure_ascii=False, sort_keys=True)
+        fixture = {
+            'query': normalize_query(query),
+            'etag': '"{}"'.format(hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]),
+            'result': result,
+        }
+
+        key = query_key(query)
+        tmppath = self.path / f'{key}.{os.getpid()}.tmp'
+        tmppath.write_text(json.dumps(fixture, ensure_ascii=False, indent=1))
+        os.replace(tmppath, self.path / f'{key}.json')
+
+        return fixture
+
+
+################################################################################
+class RecordingEndpoint():
+    '''
+    Pass the queries on to another endpoint and record every result.
+    '''
+
+    ############################################################################
+    def __init__(self, backend=None, path=FIXTURE_DIR):
+        self.backend = backend if backend is not None else LiveEndpoint()
+        self.fixtures = FixtureStore(path)
+
+    ############################################################################
+    def query(self, query, etag=None, last_modified=None):
+        '''
+        Run a query on the backend, record the full result.
+        '''
+
+        response = self.backend.query(query, etag, last_modified)
+
+        # A conditional request has no body to record, ask again without
+        if response.status == 304:
+            response = self.backend.query(query)
+
+        self.fixtures.save(query, response.result)
+
+        return response
+
+
+################################################################################
+class ReplayEndpoint():
+    '''
+    Answer the queries from recorded fixtures, each after `latency` seconds.
+    '''
+
+    ############################################################################
+    def __init__(self, path=FIXTURE_DIR, latency=0.0):
+        self.fixtures = FixtureStore(path)
+        self.latency = latency
+
+    ############################################################################
+    def query(self, query, etag=None, last_modified=None):
+        '''
+        Replay the recorded result of a query, 304 if the ETag matches.
+        '''
+
+        fixture = self.fixtures.load(query)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if etag and etag == fixture['etag']:
+            return Response(304, None, etag, last_modified)
+
+        return Response(200, fixture['result'], fixture['etag'], None)
+
+
+################################################################################
+def make_endpoint(spec=None, latency=0.0):
+    '''
+    The backend for a command line spec.
+
+    None for Wikidata, a URL for another (e.g. a local stand-in) service,
+    `record:<dir>` to record the responses of Wikidata to a directory and
+    `replay:<dir>` to answer from a recorded directory.
+    '''
+
+    if not spec:
+        return LiveEndpoint()
+
+    mode, _, path = spec.partition(':')
+
+    if mode == 'record':
+        return RecordingEndpoint(LiveEndpoint(), path or FIXTURE_DIR)
+    if mode == 'replay':
+        return ReplayEndpoint(path or FIXTURE_DIR, latency)
+
+    return LiveEndpoint(spec)
+
+
+################################################################################
+def make_server(address, fixtures=FIXTURE_DIR, latency=0.0):
+    '''
+    An HTTP server that replays the fixtures like a SPARQL service.
+    '''
+
+    replay = ReplayEndpoint(fixtures, latency)
+
+    class Handler(BaseHTTPRequestHandler):
+        '''Answer SPARQL protocol GET and POST requests.'''
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            '''Query in the URL.'''
+
+            self.answer(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            '''Query in the form data.'''
+
+            length = int(self.headers.get('Content-Length', 0))
+            self.answer(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+        def answer(self, params):
+            '''Send the recorded result.'''
+
+            try:
+                response = replay.query(params['query'][0],
+                                        self.headers.get('If-None-Match'))
+            except (KeyError, MissingFixtureError) as err:
+                self.send_error(404, str(err))
+                return
+
+            self.send_response(response.status)
+            self.send_header('ETag', response.etag)
+
+            if response.status == 304:
+                self.end_headers()
+                return
+
+            body = json.dumps(response.result).encode('utf-8')
+
+            self.send_header('Content-Type', 'application/sparql-results+json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            '''Stay quiet.'''
+
+    return ThreadingHTTPServer(address, Handler)
+
+
+################################################################################
+def main():
+    '''Record SPARQL responses or serve them from a local stand-in server.'''
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record = subparsers.add_parser('record', help='record the results of queries')
+    record.add_argument('queries', nargs='+', type=Path, help='.rq files')
+    record.add_argument('--fixtures', type=Path, default=FIXTURE_DIR)
+    record.add_argument('--endpoint', default=ENDPOINT_URL)
+
+    serve = subparsers.add_parser('serve', help='replay the recorded results')
+    serve.add_argument('--fixtures', type=Path, default=FIXTURE_DIR)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8890)
+    serve.add_argument('--latency', type=float, default=0.0,
+                       help='seconds before each response')
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        recorder = RecordingEndpoint(LiveEndpoint(args.endpoint), args.fixtures)
+
+        for path in args.queries:
+            result = recorder.query(path.read_text()).result
+            print(f'{path}: {len(result["results"]["bindings"])} rows')
+
+    else:
+        server = make_server((args.host, args.port), args.fixtures, args.latency)
+        print(f'Serving {args.fixtures} on http://{args.host}:{args.port}/sparql')
+
+        with server:
+            server.serve_forever()
+
+
+################################################################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,559 @@
+'''
+Find the elements of the SVG maps and where they are, cut maps to a region.
+
+Like core.svgmin the maps are not parsed as XML (they are editor exports and
+not always well-formed) but scanned tag by tag into a flat list of elements
+with their position in the markup. The bounding box of every element is
+computed in the coordinates of the root viewBox, through the transforms of
+the element and its ancestors, so that a subset of the elements can be cut
+out of the markup with a viewBox that fits them:
+
+    svg_map = SvgMap(Path('jp/svg/MapJapan_final.svg').read_text())
+    svg_map.bbox(['Tokyo', 'Chiba'])
+    kanto = svg_map.subset(['Region-Kanto'])
+
+The IDs of a map and their boxes are kept in a MapIndex, stored under
+.cache/maps keyed on the hash of the map, so the map IDs of the notes can be
+checked against it and maps cut without scanning their boxes again:
+
+    index = map_index('jp/svg/MapJapan_final.svg')
+    index.check(['Tokyo', 'Tokyo-Shinjuku'])
+'''
+
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+from core.svgmin import PATH_TOKEN, parse_path
+
+TAG = re.compile(r'<(/?)([\w:-]+)([^<>]*?)(/?)>|<!--.*?-->|<[?!][^<>]*>', re.DOTALL)
+ATTR = re.compile(r'([\w:-]+)\s*=\s*"([^"]*)"')
+TRANSFORM = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+SPACE = re.compile(r'\s*')
+VIEWBOX = re.compile(r'(\sview[bB]ox\s*=\s*")([^"]*)(")')
+
+# Elements that are never drawn themselves, they are kept in every subset
+KEEP_TAGS = {'defs', 'style', 'script', 'title', 'desc', 'symbol', 'marker', 'clipPath',
+             'mask', 'pattern', 'linearGradient', 'radialGradient', 'filter'}
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+INDEX_DIR = Path(__file__).resolve().parent.parent / '.cache' / 'maps'
+
+# A scanned element: `start` and `end` are its span in the markup, `parent`
+# its parent's index (None for the root), `ctm` the transform to the root
+MapElement = namedtuple('MapElement', 'tag, id, attrs, start, end, parent, ctm')
+
+
+################################################################################
+def multiply(first, second):
+    '''
+    The affine transform (a, b, c, d, e, f) applying `second`, then `first`.
+    '''
+
+    a1, b1, c1, d1, e1, f1 = first
+    a2, b2, c2, d2, e2, f2 = second
+
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+            a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+
+################################################################################
+def parse_transform(text):
+    '''
+    The affine transform of a transform attribute.
+    '''
+
+    matrix = IDENTITY
+
+    for name, args in TRANSFORM.findall(text or ''):
+        values = [float(value) for value in PATH_TOKEN.findall(args)]
+
+        if name == 'matrix':
+            step = tuple(values[:6])
+        elif name == 'translate':
+            step = (1.0, 0.0, 0.0, 1.0, values[0], values[1] if len(values) > 1 else 0.0)
+        elif name == 'scale':
+            step = (values[0], 0.0, 0.0, values[1] if len(values) > 1 else values[0], 0.0, 0.0)
+        elif name == 'rotate':
+            angle = math.radians(values[0])
+            cx, cy = values[1:3] if len(values) > 2 else (0.0, 0.0)
+            cos, sin = math.cos(angle), math.sin(angle)
+            step = (cos, sin, -sin, cos, cx - cos * cx + sin * cy, cy - sin * cx - cos * cy)
+        elif name == 'skewX':
+            step = (1.0, 0.0, math.tan(math.radians(values[0])), 1.0, 0.0, 0.0)
+        else:
+            step = (1.0, math.tan(math.radians(values[0])), 0.0, 1.0, 0.0, 0.0)
+
+        matrix = multiply(matrix, step)
+
+    return matrix
+
+
+################################################################################
+def apply(matrix, points):
+    '''
+    The points transformed by the matrix.
+    '''
+
+    a, b, c, d, e, f = matrix
+
+    return [(a * x + c * y + e, b * x + d * y + f) for x, y in points]
+
+
+################################################################################
+def bounds(points):
+    '''
+    The box (min x, min y, max x, max y) around the points, None if there are none.
+    '''
+
+    if not points:
+        return None
+
+    xs, ys = zip(*points)
+
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+################################################################################
+def union(boxes):
+    '''
+    The box around the boxes, None if there are none.
+    '''
+
+    boxes = [box for box in boxes if box is not None]
+
+    return bounds([corner for box in boxes for corner in (box[:2], box[2:])])
+
+
+################################################################################
+def corners(box):
+    '''
+    The four corners of a box.
+    '''
+
+    x0, y0, x1, y1 = box
+
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+
+
+################################################################################
+def number(attrs, name, default=0.0):
+    '''
+    A numeric attribute, `default` if it is missing or not a plain number.
+    '''
+
+    try:
+        return float(attrs.get(name, default))
+    except ValueError:
+        return default
+
+
+################################################################################
+def shape_points(tag, attrs):
+    '''
+    Points spanning the shape of an element in its own coordinates.
+
+    For curves these are the control points, so the box around them might be
+    a bit larger than the curve, never smaller.
+    '''
+
+    if tag == 'path' and attrs.get('d'):
+        return [(args[idx], args[idx + 1])
+                for cmd, args in parse_path(attrs['d'])
+                for idx in ((5,) if cmd == 'A' else range(0, len(args), 2))]
+
+    if tag in ('polygon', 'polyline'):
+        values = [float(value) for value in PATH_TOKEN.findall(attrs.get('points', ''))]
+        return list(zip(values[::2], values[1::2]))
+
+    if tag in ('circle', 'ellipse'):
+        cx, cy = number(attrs, 'cx'), number(attrs, 'cy')
+        rx = number(attrs, 'rx', number(attrs, 'r'))
+        ry = number(attrs, 'ry', number(attrs, 'r'))
+        return corners((cx - rx, cy - ry, cx + rx, cy + ry))
+
+    if tag in ('rect', 'image'):
+        x, y = number(attrs, 'x'), number(attrs, 'y')
+        return corners((x, y, x + number(attrs, 'width'), y + number(attrs, 'height')))
+
+    if tag == 'line':
+        return [(number(attrs, 'x1'), number(attrs, 'y1')),
+                (number(attrs, 'x2'), number(attrs, 'y2'))]
+
+    return []
+
+
+################################################################################
+class SvgMap():
+    '''
+    The elements of a map, their IDs and bounding boxes.
+    '''
+
+    ############################################################################
+    def __init__(self, text, boxes=None):
+        '''
+        `boxes` are already known boxes by ID, e.g. the boxes of a MapIndex.
+        '''
+
+        self.text = text
+        self.elements = []
+        self.ids = {}
+        self.children = []
+
+        self._boxes = {}
+
+        self.scan()
+
+        for eid, box in (boxes or {}).items():
+            if eid in self.ids:
+                self._boxes[self.ids[eid]] = box
+
+    ############################################################################
+    def scan(self):
+        '''
+        Collect the elements and their spans in the markup.
+        '''
+
+        stack = []
+
+        for match in TAG.finditer(self.text):
+            closing, tag, attr_text, empty = match.groups()
+
+            if tag is None:
+                continue
+
+            if closing:
+                # Close the innermost element of this name and what is still
+                # open inside it, a stray end tag is ignored
+                if tag in [self.elements[idx].tag for idx in stack]:
+                    while self.elements[stack[-1]].tag != tag:
+                        self.close(stack.pop(), match.start())
+
+                    self.close(stack.pop(), match.end())
+                continue
+
+            # The Japan map has <defs> where </defs> is meant, a definition
+            # inside another one would hide the whole map
+            if tag == 'defs' and stack and self.elements[stack[-1]].tag == 'defs':
+                self.close(stack.pop(), match.end())
+                continue
+
+            attrs = dict(ATTR.findall(attr_text))
+            parent = stack[-1] if stack else None
+
+            ctm = parse_transform(attrs.get('transform'))
+            if parent is not None:
+                ctm = multiply(self.elements[parent].ctm, ctm)
+
+            idx = len(self.elements)
+            self.elements.append(MapElement(tag, attrs.get('id'), attrs, match.start(),
+                                            match.end(), parent, ctm))
+            self.children.append([])
+
+            if parent is not None:
+                self.children[parent].append(idx)
+            if attrs.get('id'):
+                self.ids.setdefault(attrs['id'], idx)
+
+            if not empty:
+                stack.append(idx)
+
+        while stack:
+            self.close(stack.pop(), len(self.text))
+
+    ############################################################################
+    def close(self, idx, end):
+        '''
+        Set where an element ends in the markup.
+        '''
+
+        self.elements[idx] = self.elements[idx]._replace(end=end)
+
+    ############################################################################
+    def ancestors(self, idx):
+        '''
+        The indices of the ancestors of an element, the parent first.
+        '''
+
+        parent = self.elements[idx].parent
+
+        while parent is not None:
+            yield parent
+            parent = self.elements[parent].parent
+
+    ############################################################################
+    def descendants(self, idx):
+        '''
+        The indices of an element and everything in it.
+        '''
+
+        pending = [idx]
+
+        while pending:
+            idx = pending.pop()
+            yield idx
+            pending.extend(self.children[idx])
+
+    ############################################################################
+    def hidden(self, idx):
+        '''
+        Whether an element is a definition or inside one, i.e. not drawn there.
+        '''
+
+        return any(self.elements[other].tag in KEEP_TAGS
+                   for other in (idx, *self.ancestors(idx)))
+
+    ############################################################################
+    def element_box(self, idx):
+        '''
+        The bounding box of an element and its content in root coordinates.
+        '''
+
+        if idx in self._boxes:
+            return self._boxes[idx]
+
+        element = self.elements[idx]
+        boxes = []
+
+        if not self.hidden(idx):
+            boxes.append(bounds(apply(element.ctm, shape_points(element.tag, element.attrs))))
+
+            if element.tag == 'use':
+                boxes.append(self.use_box(element))
+
+            boxes.extend(self.element_box(child) for child in self.children[idx])
+
+        self._boxes[idx] = union(boxes)
+
+        return self._boxes[idx]
+
+    ############################################################################
+    def use_box(self, element):
+        '''
+        The box of the element a <use> shows, moved to where it is used.
+        '''
+
+        href = element.attrs.get('xlink:href', element.attrs.get('href', ''))
+        ref = self.ids.get(href.lstrip('#'))
+
+        if ref is None:
+            return None
+
+        points = [point for idx in self.descendants(ref)
+                  for point in apply(self.elements[idx].ctm,
+                                     shape_points(self.elements[idx].tag,
+                                                  self.elements[idx].attrs))]
+
+        offset = (1.0, 0.0, 0.0, 1.0, number(element.attrs, 'x'), number(element.attrs, 'y'))
+
+        return bounds(apply(multiply(element.ctm, offset), points))
+
+    ############################################################################
+    def bbox(self, ids):
+        '''
+        The box around the elements with these IDs, None if none is drawn.
+        '''
+
+        return union(self.element_box(self.ids[eid]) for eid in ids if eid in self.ids)
+
+    ############################################################################
+    def subset(self, ids, padding=0.03):
+        '''
+        The map with only the elements with these IDs (and what they contain),
+        their ancestors and the definitions, with a viewBox around them.
+
+        `padding` is added around the box, as a fraction of its larger side.
+        Unknown IDs are ignored, the IDs of the kept elements do not change.
+        '''
+
+        keep = {idx for eid in ids if eid in self.ids
+                for idx in self.descendants(self.ids[eid])}
+
+        if not keep:
+            raise ValueError(f'None of {", ".join(ids)} is on the map')
+
+        containers = {parent for idx in keep for parent in self.ancestors(idx)}
+
+        # Cut the largest parts that are neither kept nor contain kept elements
+        cuts = [(element.start, element.end) for idx, element in enumerate(self.elements)
+                if idx not in keep and idx not in containers
+                and element.parent in containers and element.tag not in KEEP_TAGS]
+
+        parts = []
+        pos = 0
+
+        for start, end in sorted(cuts):
+            parts.append(self.text[pos:start])
+            # With the whitespace up to the next element
+            pos = SPACE.match(self.text, end).end()
+
+        parts.append(self.text[pos:])
+        text = ''.join(parts)
+
+        x0, y0, x1, y1 = self.bbox(ids)
+        pad = padding * max(x1 - x0, y1 - y0)
+        box = (x0 - pad, y0 - pad, x1 - x0 + 2 * pad, y1 - y0 + 2 * pad)
+
+        return self.with_viewbox(text, box)
+
+    ############################################################################
+    @staticmethod
+    def with_viewbox(text, box):
+        '''
+        The markup with the root viewBox (and size, if given) set to a box.
+        '''
+
+        root = TAG.search(text, text.find('<svg'))
+        tag = root.group(0)
+
+        viewbox = ' '.join(f'{value:.1f}' for value in box)
+
+        if VIEWBOX.search(tag):
+            tag = VIEWBOX.sub(lambda m: m.group(1) + viewbox + m.group(3), tag)
+        else:
+            tag = tag.replace('<svg', f'<svg viewBox="{viewbox}"', 1)
+
+        for name, value in (('width', box[2]), ('height', box[3])):
+            tag = re.sub(r'(\s%s\s*=\s*")[^"]*(")' % name,
+                         lambda m, value=value: f'{m.group(1)}{value:.0f}{m.group(2)}', tag)
+
+        return text[:root.start()] + tag + text[root.end():]
+
+
+################################################################################
+class MapIndex():
+    '''
+    The IDs of a map with the tag and box of their element and the ID of the
+    closest ancestor that has one.
+    '''
+
+    ############################################################################
+    def __init__(self, name, elements):
+        self.name = name
+        self.elements = elements
+
+    ############################################################################
+    def __contains__(self, eid):
+        return eid in self.elements
+
+    ############################################################################
+    @classmethod
+    def from_map(cls, name, svg_map):
+        '''
+        The index of a scanned map.
+        '''
+
+        elements = {}
+
+        for eid, idx in svg_map.ids.items():
+            parent = next((svg_map.elements[other].id for other in svg_map.ancestors(idx)
+                           if svg_map.elements[other].id), None)
+
+            elements[eid] = {'tag': svg_map.elements[idx].tag,
+                             'bbox': svg_map.element_box(idx),
+                             'parent': parent}
+
+        return cls(name, elements)
+
+    ############################################################################
+    @classmethod
+    def load(cls, svg_path, index_dir=INDEX_DIR):
+        '''
+        The index of a map file, only scanned again if the map changed.
+        '''
+
+        svg_path = Path(svg_path)
+        text = svg_path.read_text()
+
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:24]
+        index_path = Path(index_dir) / f'{svg_path.stem}.{digest}.json'
+
+        try:
+            elements = json.loads(index_path.read_text())
+        except (OSError, ValueError):
+            index = cls.from_map(svg_path.name, SvgMap(text))
+
+            # Indexes of earlier versions of the map are of no use anymore, other
+            # builds might remove them at the same time
+            for stale in Path(index_dir).glob(f'{svg_path.stem}.*.json'):
+                if stale != index_path:
+                    stale.unlink(missing_ok=True)
+
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+
+            tmppath = index_path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+            tmppath.write_text(json.dumps(index.elements, indent=4, sort_keys=True))
+            os.replace(tmppath, index_path)
+
+            return index
+
+        for element in elements.values():
+            if element['bbox'] is not None:
+                element['bbox'] = tuple(element['bbox'])
+
+        return cls(svg_path.name, elements)
+
+    ############################################################################
+    def boxes(self):
+        '''
+        The box of every ID, e.g. for SvgMap.
+        '''
+
+        return {eid: element['bbox'] for eid, element in self.elements.items()}
+
+    ############################################################################
+    def bbox(self, ids):
+        '''
+        The box around the elements with these IDs, None if none is drawn.
+        '''
+
+        return union(self.elements[eid]['bbox'] for eid in ids if eid in self.elements)
+
+    ############################################################################
+    def center(self, eid):
+        '''
+        The center of the box of an element, e.g. to place a label.
+        '''
+
+        x0, y0, x1, y1 = self.elements[eid]['bbox']
+
+        return ((x0 + x1) / 2, (y0 + y1) / 2)
+
+    ############################################################################
+    def missing(self, map_ids):
+        '''
+        The IDs in the `map_ids` fields (comma separated) that are not on the map.
+        '''
+
+        return sorted({eid for value in map_ids for eid in value.split(', ')
+                       if eid not in self.elements})
+
+    ############################################################################
+    def check(self, map_ids):
+        '''
+        Make sure all IDs in the `map_ids` fields are on the map.
+        '''
+
+        missing = self.missing(map_ids)
+
+        if missing:
+            raise ValueError(f'Not on {self.name}: {", ".join(missing)}')
+
+
+################################################################################
+@lru_cache(maxsize=None)
+def map_index(svg_path):
+    '''
+    The index of a map file, loaded once per process.
+    '''
+
+    return MapIndex.load(svg_path)
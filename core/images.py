@@ -0,0 +1,299 @@
+'''
+Download the images referenced in Wikidata and rasterize them for the decks.
+'''
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from core import profile
+from core.session import make_session
+
+STORE_DIR = Path(__file__).resolve().parent.parent / '.cache' / 'images'
+
+ImageJob = namedtuple('ImageJob', 'url, srcpath, pngpath')
+
+
+################################################################################
+def url_filename(url):
+    '''
+    The (still quoted) file name at the end of an image URL.
+    '''
+
+    return Path(urlparse(url).path).name
+
+
+################################################################################
+def image_jobs(items, itype, srcdir, pngdir):
+    '''
+    Map (name, url) pairs to the jobs that turn them into `<name>_<itype>.png`.
+    '''
+
+    return [
+        ImageJob(url,
+                 Path(srcdir) / url_filename(url),
+                 Path(pngdir) / f'{name.replace(" ", "_")}_{itype}.png')
+        for name, url in items if url]
+
+
+################################################################################
+class AssetStore():
+    '''
+    Content-addressed store for rendered images.
+
+    A render is keyed on the hash of its source bytes and the render
+    parameters and kept once in `store_dir`. The manifest of each output
+    directory, kept in `store_dir` as well, records which key every output was
+    made from and the HTTP validators of every source URL, so only images
+    whose inputs changed are downloaded or rendered again.
+    '''
+
+    _lock = threading.Lock()
+
+    ############################################################################
+    def __init__(self, pngdir, store_dir=STORE_DIR):
+        self.store_dir = Path(store_dir)
+
+        # Not next to the outputs, the decks' image directories are tracked
+        pngdir = Path(pngdir).resolve()
+        digest = hashlib.sha256(str(pngdir).encode('utf-8')).hexdigest()[:16]
+        self.manifest_path = self.store_dir / 'manifests' / f'{pngdir.name}.{digest}.json'
+
+    ############################################################################
+    def load(self):
+        '''
+        The manifest, empty if there is none yet.
+        '''
+
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            manifest = {}
+
+        manifest.setdefault('sources', {})
+        manifest.setdefault('outputs', {})
+
+        return manifest
+
+    ############################################################################
+    def update(self, sources=None, outputs=None):
+        '''
+        Merge new entries into the manifest on disk.
+        '''
+
+        with self._lock:
+            manifest = self.load()
+            manifest['sources'].update(sources or {})
+            manifest['outputs'].update(outputs or {})
+
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+            tmppath = self.manifest_path.with_suffix(f'.{os.getpid()}.tmp')
+            tmppath.write_text(json.dumps(manifest, indent=4, sort_keys=True))
+            os.replace(tmppath, self.manifest_path)
+
+    ############################################################################
+    @staticmethod
+    def key(srcpath, **params):
+        '''
+        Hash of the source bytes and the render parameters.
+        '''
+
+        digest = hashlib.sha256(Path(srcpath).read_bytes())
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    ############################################################################
+    def path(self, key):
+        '''
+        Where the render with this key is kept.
+        '''
+
+        return self.store_dir / f'{key}.png'
+
+
+################################################################################
+def write_atomic(path, data):
+    '''
+    Write the bytes to a file that is either complete or not there at all.
+    '''
+
+    tmppath = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    tmppath.write_bytes(data)
+    os.replace(tmppath, path)
+
+
+################################################################################
+def download(jobs, sources=None, refresh=False, max_workers=8):
+    '''
+    Fetch the sources of all jobs.
+
+    Sources that are on disk are revalidated with the validators in `sources`
+    (URL -> ETag/Last-Modified, updated in place), or kept as they are if
+    `refresh` is not set.
+    '''
+
+    sources = sources if sources is not None else {}
+
+    todo = {job.srcpath: job.url for job in jobs
+            if refresh or not job.srcpath.is_file()}
+
+    if not todo:
+        return sources
+
+    session = make_session(max_workers)
+
+    def fetch(item):
+        srcpath, url = item
+        headers = {}
+
+        if srcpath.is_file():
+            if sources.get(url, {}).get('etag'):
+                headers['If-None-Match'] = sources[url]['etag']
+            if sources.get(url, {}).get('last_modified'):
+                headers['If-Modified-Since'] = sources[url]['last_modified']
+
+        response = session.get(url, headers=headers, timeout=60)
+
+        if response.status_code == 304:
+            return
+
+        response.raise_for_status()
+
+        srcpath.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(srcpath, response.content)
+
+        profile.count('images.bytes_fetched', len(response.content))
+
+        sources[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+    with session, ThreadPoolExecutor(max_workers) as executor, profile.span('download'):
+        # Consume the results to surface the first error
+        list(executor.map(fetch, todo.items()))
+
+    return sources
+
+
+################################################################################
+def rasterize(srcpath, pngpath, resize='x128'):
+    '''
+    Render an image (usually an SVG) to a PNG with a transparent background.
+    '''
+
+    # Only needed in the worker processes, keep the import cheap otherwise
+    from wand.api import library as wandlib  # pylint: disable=import-outside-toplevel
+    import wand.color  # pylint: disable=import-outside-toplevel
+    import wand.image  # pylint: disable=import-outside-toplevel
+
+    with wand.image.Image() as image:
+        with wand.color.Color('transparent') as background_color:
+            wandlib.MagickSetBackgroundColor(image.wand, background_color.resource)
+
+        image.read(blob=Path(srcpath).read_bytes())
+        image.transform(resize=resize)
+
+        pngpath.parent.mkdir(parents=True, exist_ok=True)
+
+        # A render that is cut short must not be taken for a finished one
+        write_atomic(pngpath, image.make_blob('png32'))
+
+    return pngpath
+
+
+################################################################################
+def prepare_images(jobs, resize='x128', refresh=False, max_workers=8):
+    '''
+    Download and rasterize all images, return the PNG path for each job.
+
+    Downloads share one session on a thread pool, the rendering is done by
+    render_images().
+    '''
+
+    jobs = list(jobs)
+
+    for pngdir in {job.pngpath.parent for job in jobs}:
+        store = AssetStore(pngdir)
+
+        sources = download([job for job in jobs if job.pngpath.parent == pngdir],
+                           store.load()['sources'], refresh, max_workers)
+        store.update(sources=sources)
+
+    return render_images(jobs, resize)
+
+
+################################################################################
+def render_images(jobs, resize='x128'):
+    '''
+    Rasterize the sources of all jobs, return the PNG path for each job.
+
+    The CPU bound rendering runs in a process pool. Only outputs whose source
+    bytes or render parameters changed since the last build are rendered
+    again.
+    '''
+
+    jobs = list(jobs)
+    stores = {}
+
+    for job in jobs:
+        stores.setdefault(job.pngpath.parent, AssetStore(job.pngpath.parent))
+
+    manifests = {pngdir: store.load() for pngdir, store in stores.items()}
+
+    outputs = {pngdir: {} for pngdir in stores}
+    renders = {}
+
+    for job in jobs:
+        store = stores[job.pngpath.parent]
+        key = store.key(job.srcpath, resize=resize, format='png32')
+
+        if (job.pngpath.is_file() and
+                manifests[job.pngpath.parent]['outputs'].get(job.pngpath.name) == key):
+            profile.count('images.up_to_date')
+            continue
+
+        if not store.path(key).is_file():
+            renders[store.path(key)] = job.srcpath
+
+        outputs[job.pngpath.parent][job.pngpath.name] = key
+
+    profile.count('images.rendered', len(renders))
+
+    if renders:
+        # Fresh interpreters, the builds' threads must not be forked
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as executor, \
+                profile.span('rasterize'):
+            list(executor.map(rasterize,
+                              renders.values(),
+                              renders.keys(),
+                              [resize] * len(renders)))
+
+    for pngdir, store_outputs in outputs.items():
+        pngdir.mkdir(parents=True, exist_ok=True)
+
+        for name, key in store_outputs.items():
+            shutil.copyfile(stores[pngdir].path(key), pngdir / name)
+
+        stores[pngdir].update(outputs=store_outputs)
+
+    return [job.pngpath for job in jobs]
+
+
+################################################################################
+def img_tag(pngpath, height=128):
+    '''
+    Reference a rasterized image from a card.
+    '''
+
+    return f'<img src="{Path(pngpath).name}" height="{height}px">'
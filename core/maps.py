@@ -0,0 +1,174 @@
+'''
+Put the SVG maps into the card templates.
+
+For clients that are slow to draw the maps, map_thumbnails() renders a PNG
+of the map per note with its map IDs marked, to be shown instead of the map.
+'''
+
+import os
+import threading
+
+from pathlib import Path
+
+from core.buildstate import write_if_changed
+from core.geometry import SvgMap, map_index
+from core.images import ImageJob, render_images
+from core.svgmin import minify_svg
+
+MEDIA_DIR = Path(__file__).resolve().parent.parent / '.cache' / 'media'
+THUMBNAIL_DIR = Path(__file__).resolve().parent.parent / '.cache' / 'thumbnails'
+
+# The colors of the maps and of the marked elements on the cards (see common.css)
+THUMBNAIL_STYLE = '''
+    <style>
+        path { fill: #ffb918; stroke: black; }
+        circle { display: none; }
+        %(marked)s { fill: #bb33cc; }
+    </style>
+'''
+
+# Load the map once per reviewer session and put it in place of the
+# placeholder, synchronously so that the map exists when Kitsun sets up the
+# marked and clickable elements of the card. The placeholder is found by its
+# class, document.currentScript is null when the card HTML is set through
+# innerHTML. If the map cannot be loaded, the placeholder shows it as an
+# <object>, which cannot be clicked or styled.
+MAP_LOADER = '''
+            <div class="map_placeholder" data-media="%(media)s"></div>
+            <script>
+                (function () {
+                    var cache = window.deckMaps = window.deckMaps || {};
+                    var src = '%(media)s';
+                    var holders = document.querySelectorAll(
+                        '.map_placeholder[data-media="' + src + '"]');
+
+                    if (!(src in cache)) {
+                        try {
+                            var request = new XMLHttpRequest();
+                            request.open('GET', src, false);
+                            request.send();
+
+                            if (request.status === 200 || request.status === 0) {
+                                cache[src] = request.responseText;
+                            }
+                        } catch (error) {
+                            // Shown as an <object> below
+                        }
+                    }
+
+                    Array.prototype.forEach.call(holders, function (holder) {
+                        if (cache[src]) {
+                            holder.outerHTML = cache[src];
+                        } else {
+                            holder.innerHTML = '<object type="image/svg+xml" data="' + src + '"></object>';
+                        }
+                    });
+                })();
+            </script>'''
+
+
+################################################################################
+def media_name(svg_path, ids=None):
+    '''
+    Anki keeps media starting with an underscore even if no note uses them.
+
+    A map cut to the elements `ids` gets their IDs into its name.
+    '''
+
+    path = Path(svg_path)
+
+    if not ids:
+        return '_' + path.name
+
+    return f'_{path.stem}.{"+".join(ids)}{path.suffix}'
+
+
+################################################################################
+def map_text(svg_path, minify=None, ids=None):
+    '''
+    The map's SVG, minified with the `minify_svg` options in `minify` if given
+    and cut to the elements `ids` (see `SvgMap.subset`) if given.
+    '''
+
+    text = Path(svg_path).read_text()
+
+    if ids:
+        text = SvgMap(text, map_index(svg_path).boxes()).subset(ids)
+
+    if minify is not None:
+        text = minify_svg(text, **minify)
+
+    return text
+
+
+################################################################################
+def map_markup(svg_path, shared=False, minify=None, ids=None):
+    '''
+    The markup for a map in a card template, inline or loaded from the media.
+    '''
+
+    if not shared:
+        return map_text(svg_path, minify, ids)
+
+    return MAP_LOADER % {'media': media_name(svg_path, ids)}
+
+
+################################################################################
+def map_media(svg_path, minify=None, ids=None):
+    '''
+    Provide a map as media file for the package, return its path.
+    '''
+
+    target = MEDIA_DIR / media_name(svg_path, ids)
+    text = map_text(svg_path, minify, ids)
+
+    if not target.is_file() or target.read_text() != text:
+        MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+
+        # Other builds might package the map meanwhile, never show them half of it
+        tmppath = target.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmppath.write_text(text)
+        os.replace(tmppath, target)
+
+    return str(target)
+
+
+################################################################################
+def marked_map(text, ids):
+    '''
+    The map's SVG with the elements `ids` filled like on the marked cards.
+    '''
+
+    marked = ', '.join(f'#{eid}, #{eid} path' for eid in ids)
+    end = text.rindex('</svg>')
+
+    return text[:end] + THUMBNAIL_STYLE % {'marked': marked} + text[end:]
+
+
+################################################################################
+def map_thumbnails(items, svg_path, pngdir, minify=None, ids=None, resize='x360'):
+    '''
+    Render the map with the `map_ids` of each (name, map_ids) item marked,
+    return the path of every PNG.
+
+    The map is cut to the elements `ids` if given (see map_text()). The PNGs
+    are named after the map and the names, e.g. `MapJapan_final.Tokyo.png`.
+    Only thumbnails whose marked map changed are rendered again.
+    '''
+
+    text = map_text(svg_path, minify, ids)
+    stem = Path(media_name(svg_path, ids)).stem.lstrip('_')
+
+    THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+    jobs = []
+
+    for name, map_ids in items:
+        filename = f'{stem}.{name.replace(" ", "_")}'
+
+        write_if_changed(THUMBNAIL_DIR / f'{filename}.svg',
+                         marked_map(text, map_ids.split(', ')))
+
+        jobs.append(ImageJob(None, THUMBNAIL_DIR / f'{filename}.svg',
+                             Path(pngdir) / f'{filename}.png'))
+
+    return render_images(jobs, resize)
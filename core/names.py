@@ -0,0 +1,171 @@
+'''
+Normalize the names from Wikidata and Wikipedia for the cards and the maps.
+
+The builders need several variants of every name: the title without the
+suffixes Wikidata adds, the map ID that Kitsun accepts, the romaji and the
+aliases accepted as answers. A NameNormalizer computes all of them in one pass
+with precompiled patterns and translate tables and remembers them, since the
+same names come up again as region members, map IDs and tags.
+'''
+
+import difflib
+import unicodedata
+
+from collections import namedtuple
+from functools import lru_cache
+
+import regex
+
+# What Wikidata appends to the names of the prefectures and regions
+SUFFIXES = regex.compile(r'\s+Prefecture|\s+\(?region\)?')
+
+# The maps name the wards of Tokyo without their suffix, e.g. Tokyo-Shinjuku
+MAP_ID_SUFFIXES = regex.compile(r'-ku$')
+
+# Kitsun trips over the macrons in map IDs, romaji spell them out
+MAP_ID_CHARS = str.maketrans({'ū': 'u', 'Ō': 'O', 'ō': 'o'})
+ROMAJI_CHARS = str.maketrans({'ū': 'uu', 'Ō': 'Oo', 'ō': 'ou'})
+
+# Footnote marks and macrons in the Wikipedia tables
+TABLE_CHARS = str.maketrans({'¹': None, '²': None, '³': None, 'ū': 'u', 'ō': 'o'})
+
+NON_ALNUM = regex.compile(r'[^\p{L}\p{N}]+')
+
+Names = namedtuple('Names', 'title, map_id, romaji, aliases')
+
+
+################################################################################
+class NameNormalizer():
+    '''
+    All variants of a name, each name is normalized once.
+
+    `suffixes` is removed from the names and `map_id_suffixes` from the map
+    IDs, `map_id` and `romaji` are translate tables for the variants (None
+    keeps the title). The aliases are the distinct variants in the order
+    title, map ID (with the map ID suffixes), romaji.
+    '''
+
+    ############################################################################
+    def __init__(self, suffixes=SUFFIXES, map_id=MAP_ID_CHARS, romaji=ROMAJI_CHARS,
+                 map_id_suffixes=MAP_ID_SUFFIXES, cache_size=None):
+        self.suffixes = suffixes
+        self.map_id_chars = map_id
+        self.romaji_chars = romaji
+        self.map_id_suffixes = map_id_suffixes
+
+        self.variants = lru_cache(maxsize=cache_size)(self._variants)
+
+    ############################################################################
+    def _variants(self, name):
+        '''
+        The variants of a name, see variants().
+        '''
+
+        title = self.suffixes.sub('', name) if self.suffixes else name
+
+        spelled = title.translate(self.map_id_chars) if self.map_id_chars else title
+        romaji = title.translate(self.romaji_chars) if self.romaji_chars else title
+
+        # The suffixes are only left out on the maps, they are still answers
+        map_id = self.map_id_suffixes.sub('', spelled) if self.map_id_suffixes else spelled
+
+        return Names(title, map_id, romaji, tuple(dict.fromkeys((title, spelled, romaji))))
+
+    ############################################################################
+    def title(self, name):
+        '''
+        The name without the suffixes.
+        '''
+
+        return self.variants(name).title
+
+    ############################################################################
+    def map_id(self, name):
+        '''
+        The ID of the name on the maps.
+        '''
+
+        return self.variants(name).map_id
+
+    ############################################################################
+    def romaji(self, name):
+        '''
+        The name with the long vowels spelled out.
+        '''
+
+        return self.variants(name).romaji
+
+    ############################################################################
+    def aliases(self, name):
+        '''
+        All representations of the name in a single line.
+        '''
+
+        return ', '.join(self.variants(name).aliases)
+
+
+################################################################################
+@lru_cache(maxsize=None)
+def clean_cell(text):
+    '''
+    The text of a Wikipedia table cell without whitespace around it, footnote
+    marks and macrons.
+    '''
+
+    return text.strip().translate(TABLE_CHARS)
+
+
+################################################################################
+@lru_cache(maxsize=4096)
+def fold(text):
+    '''
+    The key of an answer: lower case, without diacritics and punctuation.
+    '''
+
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text)
+                   if not unicodedata.combining(char))
+
+    return NON_ALNUM.sub(' ', text.casefold()).strip()
+
+
+################################################################################
+class NameIndex():
+    '''
+    Look up entities by any variant of their names, e.g. to check answers.
+
+        index = NameIndex()
+        index.add('Tōkyō', 'Tokyo Metropolis')
+        index.lookup('tokyou')  # 'Tōkyō'
+    '''
+
+    ############################################################################
+    def __init__(self, normalizer=None):
+        self.normalizer = normalizer or NameNormalizer()
+        self.keys = {}
+
+    ############################################################################
+    def add(self, entity, *names):
+        '''
+        Index the entity under all variants of its own and the other names.
+        '''
+
+        for name in (entity, *names):
+            for alias in (name, *self.normalizer.variants(name).aliases):
+                self.keys.setdefault(fold(alias), entity)
+
+        return self
+
+    ############################################################################
+    def lookup(self, answer, cutoff=0.8):
+        '''
+        The entity an answer names, the closest one for a typo, else None.
+        '''
+
+        key = fold(answer)
+
+        if key in self.keys:
+            return self.keys[key]
+
+        matches = difflib.get_close_matches(key, self.keys, n=1, cutoff=cutoff)
+
+        return self.keys[matches[0]] if matches else None
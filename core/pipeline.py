@@ -0,0 +1,180 @@
+'''
+Run the stages of a deck build as a dependency graph.
+'''
+
+import asyncio
+import inspect
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from core import profile
+
+
+################################################################################
+class Stage(namedtuple('Stage', 'name, func, inputs, outputs')):
+    '''
+    Declare a build stage.
+
+    The stage calls `func` with the results named in `inputs` as positional
+    arguments. A stage with a single output (by default named after the
+    function) stores the return value, with several outputs the return value
+    is unpacked into them. Coroutine functions run on the pipeline's event
+    loop instead of a worker thread.
+    '''
+
+    __slots__ = ()
+
+    def __new__(cls, func, inputs=(), outputs=None, name=None):
+        name = name or func.__name__
+
+        return super().__new__(cls, name, func, tuple(inputs), tuple(outputs or (name,)))
+
+
+################################################################################
+class EventLoop():
+    '''
+    An asyncio event loop running in a background thread while in use.
+    '''
+
+    ############################################################################
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+    ############################################################################
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        return self.loop
+
+    ############################################################################
+    def __exit__(self, exc_type, exc_value, traceback):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    ############################################################################
+    @staticmethod
+    async def shutdown():
+        '''
+        Cancel what is left (after an error) and wait for the worker threads.
+        '''
+
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.get_running_loop().shutdown_default_executor()
+
+
+################################################################################
+class Pipeline():
+    '''
+    Run each required stage exactly once, independent stages concurrently.
+
+    Plain stages run on a pool of `max_workers` threads. Async stages (e.g.
+    queries that mostly wait for the network) all run on one event loop and
+    do not take up a worker, so any number of them can be in flight.
+    '''
+
+    ############################################################################
+    def __init__(self, stages, max_workers=4):
+        self.stages = list(stages)
+        self.max_workers = max_workers
+
+        self.producers = {}
+
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f'Output {output} is produced twice')
+
+                self.producers[output] = stage
+
+    ############################################################################
+    def required(self, targets):
+        '''
+        All stages that are needed to produce the targets.
+        '''
+
+        required = {}
+        pending = list(targets)
+
+        while pending:
+            output = pending.pop()
+
+            try:
+                stage = self.producers[output]
+            except KeyError:
+                raise ValueError(f'No stage produces {output}') from None
+
+            if stage.name not in required:
+                required[stage.name] = stage
+                pending.extend(stage.inputs)
+
+        return list(required.values())
+
+    ############################################################################
+    def run(self, targets=None, results=None):
+        '''
+        Build the targets (default: everything) and return all results.
+
+        Already known results can be passed in and are not rebuilt.
+        '''
+
+        results = dict(results or {})
+        targets = targets if targets is not None else list(self.producers)
+
+        todo = [stage for stage in self.required(
+            [target for target in targets if target not in results])
+                if not set(stage.outputs) <= set(results)]
+
+        running = {}
+
+        with ThreadPoolExecutor(self.max_workers) as executor, EventLoop() as loop:
+            while todo or running:
+                for stage in [stage for stage in todo
+                              if all(name in results for name in stage.inputs)]:
+                    todo.remove(stage)
+                    args = [results[name] for name in stage.inputs]
+
+                    # Timed as a span of the build if profiling
+                    func = profile.wrap(stage.func, stage.name)
+
+                    if inspect.iscoroutinefunction(stage.func):
+                        future = asyncio.run_coroutine_threadsafe(func(*args), loop)
+                    else:
+                        future = executor.submit(func, *args)
+
+                    running[future] = stage
+
+                if not running:
+                    raise ValueError('Cyclic dependencies between stages: ' +
+                                     ', '.join(stage.name for stage in todo))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage = running.pop(future)
+
+                    try:
+                        value = future.result()
+                    except BaseException:
+                        for other in running:
+                            other.cancel()
+                        raise
+
+                    if len(stage.outputs) == 1:
+                        results[stage.outputs[0]] = value
+                    else:
+                        results.update(zip(stage.outputs, value))
+
+        return results
@@ -0,0 +1,294 @@
+'''
+Opt-in instrumentation of the deck builds.
+
+Spans record the wall and CPU time of the build stages and the steps within
+them, counters add up bytes fetched, cache hits and the like. Both cost next
+to nothing unless profiling was enabled with configure_profile(). The report
+is a JSON summary and, next to it, the spans as collapsed stacks
+(`stage;step <microseconds>` per line) for flamegraph.pl or speedscope.
+'''
+
+import contextvars
+import functools
+import inspect
+import json
+import threading
+import time
+
+from collections import defaultdict
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+# The names of the open spans in the current thread or task
+STACK = contextvars.ContextVar('profile_stack', default=())
+
+
+################################################################################
+def peak_rss():
+    '''
+    Peak resident set size in bytes of this process and of its finished
+    children (e.g. the rasterizing workers), None where it is unknown.
+    '''
+
+    if resource is None:
+        return None
+
+    # Kilobytes on Linux
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+
+################################################################################
+class Profiler():
+    '''
+    Collect spans and counters from all threads of a build.
+
+    The CPU time of a span is the CPU time of the thread it ran in, for spans
+    of coroutines it includes whatever else ran on the event loop meanwhile.
+    '''
+
+    ############################################################################
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+
+        self.spans = defaultdict(lambda: {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+        self.counters = defaultdict(int)
+
+        self._lock = threading.Lock()
+
+    ############################################################################
+    def span(self, name):
+        '''
+        Context manager timing a block as a child of the current span.
+        '''
+
+        if not self.enabled:
+            return _NO_SPAN
+
+        return _Span(self, name)
+
+    ############################################################################
+    def count(self, name, value=1):
+        '''
+        Add to a counter.
+        '''
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.counters[name] += value
+
+    ############################################################################
+    def record(self, stack, wall, cpu):
+        '''
+        Add the times of a finished span.
+        '''
+
+        with self._lock:
+            entry = self.spans[stack]
+            entry['calls'] += 1
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+
+    ############################################################################
+    def wrap(self, func, name=None):
+        '''
+        Time every call of a function (or coroutine function) as a span.
+
+        The span is nested into the span that is open where the function is
+        wrapped, also if it is called in another thread.
+        '''
+
+        if not self.enabled:
+            return func
+
+        name = name or getattr(func, '__name__', repr(func))
+        parent = STACK.get()
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                token = STACK.set(parent)
+                try:
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+                finally:
+                    STACK.reset(token)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                token = STACK.set(parent)
+                try:
+                    with self.span(name):
+                        return func(*args, **kwargs)
+                finally:
+                    STACK.reset(token)
+
+        return wrapper
+
+    ############################################################################
+    def report(self):
+        '''
+        The summary of all spans and counters.
+        '''
+
+        with self._lock:
+            spans = [{'stack': list(stack), 'calls': entry['calls'],
+                      'wall': round(entry['wall'], 6), 'cpu': round(entry['cpu'], 6)}
+                     for stack, entry in sorted(self.spans.items())]
+            counters = dict(sorted(self.counters.items()))
+
+        return {
+            'wall': round(time.perf_counter() - self.started, 6),
+            'peak_rss': peak_rss(),
+            'spans': spans,
+            'counters': counters,
+        }
+
+    ############################################################################
+    def collapsed(self):
+        '''
+        The spans as collapsed stacks with their self time in microseconds.
+        '''
+
+        with self._lock:
+            totals = {stack: entry['wall'] for stack, entry in self.spans.items()}
+
+        children = defaultdict(float)
+
+        for stack, wall in totals.items():
+            if len(stack) > 1:
+                children[stack[:-1]] += wall
+
+        # Concurrent children can take longer than their parent in sum
+        return [f'{";".join(stack)} {max(0, round((wall - children[stack]) * 1e6))}'
+                for stack, wall in sorted(totals.items())]
+
+    ############################################################################
+    def write(self, path):
+        '''
+        Write the JSON report and the collapsed stacks next to it (.folded).
+        '''
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        path.write_text(json.dumps(self.report(), indent=4))
+        path.with_suffix('.folded').write_text('\n'.join(self.collapsed()) + '\n')
+
+        return path
+
+
+################################################################################
+class _Span():
+    '''
+    A running span, see Profiler.span().
+    '''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+        self.token = None
+        self.wall = self.cpu = None
+
+    def __enter__(self):
+        self.token = STACK.set(STACK.get() + (self.name,))
+        self.wall, self.cpu = time.perf_counter(), time.thread_time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(STACK.get(), time.perf_counter() - self.wall,
+                             time.thread_time() - self.cpu)
+        STACK.reset(self.token)
+
+
+class _NoSpan():
+    '''
+    What Profiler.span() returns while profiling is off.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+DEFAULT_PROFILER = Profiler()
+
+
+################################################################################
+def configure_profile(enabled=True):
+    '''
+    Start profiling the build (from now on) with the default profiler.
+    '''
+
+    global DEFAULT_PROFILER  # pylint: disable=global-statement
+
+    DEFAULT_PROFILER = Profiler(enabled)
+
+    return DEFAULT_PROFILER
+
+
+################################################################################
+def span(name):
+    '''
+    Time a block with the default profiler.
+    '''
+
+    return DEFAULT_PROFILER.span(name)
+
+
+################################################################################
+def count(name, value=1):
+    '''
+    Add to a counter of the default profiler.
+    '''
+
+    DEFAULT_PROFILER.count(name, value)
+
+
+################################################################################
+def wrap(func, name=None):
+    '''
+    Time every call of a function with the default profiler, see Profiler.wrap().
+    '''
+
+    return DEFAULT_PROFILER.wrap(func, name)
+
+
+################################################################################
+def profiled(name=None):
+    '''
+    Decorator timing every call of a function with the default profiler.
+    '''
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with DEFAULT_PROFILER.span(span_name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with DEFAULT_PROFILER.span(span_name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,86 @@
+'''
+Rank the items of a deck by their statistics.
+'''
+
+from itertools import groupby
+
+from core import profile
+
+# How equal values are ranked, the same names as in pandas' rank()
+TIES = ('first', 'min', 'max', 'dense')
+
+
+################################################################################
+def rank_values(values, descending=True, ties='first'):
+    '''
+    The rank (starting at 1) of every value, in the order of the values.
+
+    Equal values are ranked in order of appearance (`first`), all get the
+    lowest (`min`) or highest (`max`) rank of their group, or consecutive
+    ranks without gaps (`dense`). Missing values (None) are not ranked.
+    '''
+
+    if ties not in TIES:
+        raise ValueError(f'Unknown tie method {ties}, use one of {", ".join(TIES)}')
+
+    # A single stable sort, equal values keep their order also in reverse
+    order = sorted((idx for idx, value in enumerate(values) if value is not None),
+                   key=values.__getitem__, reverse=descending)
+
+    ranks = [None] * len(values)
+    pos = 0
+
+    for dense, (_, group) in enumerate(groupby(order, key=values.__getitem__), 1):
+        group = list(group)
+
+        for offset, idx in enumerate(group):
+            ranks[idx] = {
+                'first': pos + offset + 1,
+                'min': pos + 1,
+                'max': pos + len(group),
+                'dense': dense,
+            }[ties]
+
+        pos += len(group)
+
+    return ranks
+
+
+################################################################################
+@profile.profiled('rank')
+def rank_items(items, columns, descending=True, ties='first', suffix='_rank'):
+    '''
+    Store the rank of each item in every column as `<column><suffix>`.
+
+    `items` are dicts (or a dict of them), every column is ranked with one sort.
+    `columns` can also map the names of the ranks to the columns they rank.
+    '''
+
+    items = list(items.values() if isinstance(items, dict) else items)
+
+    if not isinstance(columns, dict):
+        columns = {column + suffix: column for column in columns}
+
+    for name, column in columns.items():
+        ranks = rank_values([item[column] for item in items], descending, ties)
+
+        for item, rank in zip(items, ranks):
+            item[name] = rank
+
+    return items
+
+
+################################################################################
+@profile.profiled('rank')
+def rank_frame(frame, columns, descending=True, ties='first', suffix='_rank'):
+    '''
+    Add a `<column><suffix>` rank column to a DataFrame for every column.
+    '''
+
+    if ties not in TIES:
+        raise ValueError(f'Unknown tie method {ties}, use one of {", ".join(TIES)}')
+
+    return frame.assign(**{
+        column + suffix: frame[column].rank(
+            method=ties, ascending=not descending).astype('Int64')
+        for column in columns})
@@ -0,0 +1,25 @@
+'''
+The HTTP client shared by the queries and the image downloads.
+'''
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = 'deck-prefectures (https://github.com/mwil/deck-prefectures)'
+
+
+################################################################################
+def make_session(pool_size=8):
+    '''
+    A keep-alive session that can serve `pool_size` threads at once.
+    '''
+
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
@@ -0,0 +1,352 @@
+'''
+Shrink the SVG maps before they go into the card templates.
+
+The maps are editor exports and not always well-formed XML, so instead of
+parsing them into a tree the markup is rewritten token by token. Elements and
+their IDs stay exactly as they are, only metadata, comments and whitespace are
+dropped and the path data is rewritten with fewer digits and points.
+'''
+
+import argparse
+import math
+import re
+
+from pathlib import Path
+
+PATH_TOKEN = re.compile(
+    r'[MmZzLlHhVvCcSsQqTtAa]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+# Number of arguments of each path command
+PATH_ARGS = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0}
+
+EDITOR_NS = ('sodipodi', 'inkscape', 'dc', 'cc', 'rdf')
+
+STRIP_PATTERNS = [
+    # XML prolog, doctype and comments
+    re.compile(r'<\?xml.*?\?>', re.DOTALL),
+    re.compile(r'<!DOCTYPE.*?>', re.DOTALL),
+    re.compile(r'<!--.*?-->', re.DOTALL),
+    # Editor metadata
+    re.compile(r'<metadata\b.*?</metadata>', re.DOTALL),
+    re.compile(r'<metadata\b[^>]*/>'),
+    re.compile(r'<({0}):(\w+)\b[^>]*/>'.format('|'.join(EDITOR_NS)), re.DOTALL),
+    re.compile(r'<({0}):(\w+)\b.*?</\1:\2>'.format('|'.join(EDITOR_NS)), re.DOTALL),
+    # Editor attributes and namespace declarations
+    re.compile(r'\s(?:xmlns:)?(?:{0})(?::[\w-]+)?="[^"]*"'.format('|'.join(EDITOR_NS))),
+]
+
+TAG = re.compile(r'<[^<>]+>')
+PATH_DATA = re.compile(r'(?<=\s)d="([^"]*)"')
+POINTS = re.compile(r'(?<=\s)points="([^"]*)"')
+
+
+################################################################################
+def parse_path(data):
+    '''
+    Split path data into segments with absolute coordinates.
+
+    Returns a list of (command, arguments) with the commands M, L, C, S, Q, T,
+    A and Z only, H and V are turned into L.
+    '''
+
+    tokens = PATH_TOKEN.findall(data)
+    segments = []
+
+    pos = 0
+    cur = start = (0.0, 0.0)
+    cmd = None
+
+    while pos < len(tokens):
+        if tokens[pos].isalpha():
+            cmd = tokens[pos]
+            pos += 1
+        elif cmd is None:
+            raise ValueError(f'Path data does not start with a command: {data[:20]}')
+
+        upper = cmd.upper()
+        nargs = PATH_ARGS[upper]
+        args = [float(token) for token in tokens[pos:pos + nargs]]
+        pos += nargs
+
+        if len(args) < nargs:
+            raise ValueError(f'Missing arguments for {cmd} in path data')
+
+        dx, dy = cur if cmd.islower() else (0.0, 0.0)
+
+        if upper == 'Z':
+            segments.append(('Z', []))
+            cur = start
+            continue
+
+        if upper == 'H':
+            upper, args = 'L', [args[0] + dx, cur[1]]
+        elif upper == 'V':
+            upper, args = 'L', [cur[0], args[0] + dy]
+        elif upper == 'A':
+            args = args[:5] + [args[5] + dx, args[6] + dy]
+        else:
+            args = [arg + (dx if idx % 2 == 0 else dy) for idx, arg in enumerate(args)]
+
+        segments.append((upper, args))
+        cur = (args[-2], args[-1])
+
+        if upper == 'M':
+            start = cur
+            # Further coordinate pairs after a moveto are linetos
+            cmd = 'l' if cmd == 'm' else 'L'
+
+    return segments
+
+
+################################################################################
+def simplify(points, tolerance):
+    '''
+    Ramer-Douglas-Peucker simplification of a polyline, keeps both ends.
+    '''
+
+    if tolerance <= 0 or len(points) < 3:
+        return points
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        length = math.hypot(x2 - x1, y2 - y1)
+
+        dmax, index = 0.0, None
+
+        for idx in range(first + 1, last):
+            x0, y0 = points[idx]
+
+            if length:
+                dist = abs((y2 - y1) * x0 - (x2 - x1) * y0 + x2 * y1 - y2 * x1) / length
+            else:
+                dist = math.hypot(x0 - x1, y0 - y1)
+
+            if dist > dmax:
+                dmax, index = dist, idx
+
+        if index is not None and dmax > tolerance:
+            keep[index] = True
+            stack.extend([(first, index), (index, last)])
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+################################################################################
+def simplify_segments(segments, tolerance):
+    '''
+    Simplify every run of straight lines in a parsed path.
+    '''
+
+    result = []
+    run = []
+    cur = start = (0.0, 0.0)
+
+    def flush():
+        if run:
+            result.extend(('L', list(point)) for point in simplify(run, tolerance)[1:])
+            run.clear()
+
+    for cmd, args in segments:
+        if cmd == 'L':
+            # The polyline starts at the current point
+            run.extend([cur, tuple(args)] if not run else [tuple(args)])
+        else:
+            flush()
+            result.append((cmd, args))
+
+        cur = start if cmd == 'Z' else (args[-2], args[-1])
+
+        if cmd == 'M':
+            start = cur
+
+    flush()
+
+    return result
+
+
+################################################################################
+def fmt_number(value, precision):
+    '''
+    Shortest representation of a number rounded to `precision` decimals.
+    '''
+
+    text = f'{round(value, precision):.{precision}f}'
+
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+
+    if text in ('-0', ''):
+        return '0'
+
+    if text.startswith('0.'):
+        return text[1:]
+    if text.startswith('-0.'):
+        return '-' + text[2:]
+
+    return text
+
+
+################################################################################
+def join_numbers(numbers):
+    '''
+    Join numbers with as few separators as possible.
+    '''
+
+    text = ''
+    prev = None
+
+    for number in numbers:
+        # A sign or a second decimal point already starts a new number
+        if prev is not None and not (
+                number.startswith('-') or (number.startswith('.') and '.' in prev)):
+            text += ' '
+
+        text += number
+        prev = number
+
+    return text
+
+
+################################################################################
+def format_path(segments, precision):
+    '''
+    Write parsed segments as relative path data, rounded without drift.
+    '''
+
+    def rnd(value):
+        return round(value, precision)
+
+    parts = []
+    cur = start = (0.0, 0.0)
+
+    for cmd, args in segments:
+        if cmd == 'Z':
+            out_cmd, values = 'z', []
+            cur = start
+        elif cmd == 'A':
+            target = (rnd(args[5]), rnd(args[6]))
+            out_cmd = 'a'
+            values = args[:5] + [target[0] - cur[0], target[1] - cur[1]]
+            cur = target
+        else:
+            out_cmd = cmd.lower()
+            values = [rnd(arg) - cur[idx % 2] for idx, arg in enumerate(args)]
+
+            if cmd == 'L' and rnd(values[1]) == 0:
+                out_cmd, values = 'h', values[:1]
+            elif cmd == 'L' and rnd(values[0]) == 0:
+                out_cmd, values = 'v', values[1:]
+
+            cur = (rnd(args[-2]), rnd(args[-1]))
+
+            if cmd == 'M':
+                start = cur
+
+        numbers = [fmt_number(value, precision) for value in values]
+
+        # A repeated command (or a lineto after a moveto) can be left out
+        if parts and out_cmd not in ('m', 'z') and (
+                parts[-1][0] == out_cmd or (parts[-1][0], out_cmd) == ('m', 'l')):
+            parts[-1][1].extend(numbers)
+        else:
+            parts.append((out_cmd, numbers))
+
+    return ''.join(cmd + join_numbers(numbers) for cmd, numbers in parts)
+
+
+################################################################################
+def minify_path(data, precision=1, tolerance=0.0):
+    '''
+    Round and simplify a path's `d` attribute.
+    '''
+
+    segments = parse_path(data)
+    segments = simplify_segments(segments, tolerance)
+
+    return format_path(segments, precision)
+
+
+################################################################################
+def minify_points(data, precision=1, tolerance=0.0):
+    '''
+    Round and simplify the `points` of a polyline or polygon.
+    '''
+
+    values = [float(token) for token in PATH_TOKEN.findall(data)]
+    points = simplify(list(zip(values[::2], values[1::2])), tolerance)
+
+    return ' '.join(f'{fmt_number(x, precision)},{fmt_number(y, precision)}'
+                    for x, y in points)
+
+
+################################################################################
+def minify_svg(text, precision=1, tolerance=0.0):
+    '''
+    Minify the markup of an SVG map, element IDs are preserved.
+    '''
+
+    for pattern in STRIP_PATTERNS:
+        text = pattern.sub('', text)
+
+    def minify_tag(match):
+        tag = match.group(0)
+        tag = PATH_DATA.sub(
+            lambda m: 'd="{}"'.format(minify_path(m.group(1), precision, tolerance)), tag)
+        tag = POINTS.sub(
+            lambda m: 'points="{}"'.format(minify_points(m.group(1), precision, tolerance)),
+            tag)
+
+        # Collapse the whitespace between the attributes
+        tag = re.sub(r'\s+', ' ', tag)
+        tag = re.sub(r'\s*(/?>)$', r'\1', tag)
+
+        return tag
+
+    text = TAG.sub(minify_tag, text)
+
+    # Empty elements can be closed right away, whitespace between tags is moot
+    text = re.sub(r'<(\w+)([^<>]*?)></\1>', r'<\1\2/>', text)
+    text = re.sub(r'>\s+<', '><', text)
+
+    return text.strip()
+
+
+################################################################################
+def main():
+    '''Minify maps and report the size saved per map.'''
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+
+    parser.add_argument('svgs', nargs='+', type=Path)
+    parser.add_argument('--precision', type=int, default=1,
+                        help='decimals kept in the coordinates')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='maximum deviation when simplifying polylines')
+    parser.add_argument('--outdir', type=Path,
+                        help='write the minified maps here (default: *.min.svg)')
+
+    args = parser.parse_args()
+
+    for svg in args.svgs:
+        text = svg.read_text()
+        minified = minify_svg(text, args.precision, args.tolerance)
+
+        outpath = (args.outdir / svg.name if args.outdir
+                   else svg.with_name(f'{svg.stem}.min.svg'))
+        outpath.parent.mkdir(parents=True, exist_ok=True)
+        outpath.write_text(minified)
+
+        size, new_size = len(text.encode()), len(minified.encode())
+
+        print(f'{svg}: {size:,d} -> {new_size:,d} bytes '
+              f'({1 - new_size / size:.0%} saved)')
+
+
+################################################################################
+if __name__ == '__main__':
+    main()
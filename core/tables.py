@@ -0,0 +1,161 @@
+'''
+Store the entity tables between the stages typed and by column.
+
+The stages keep the statistics as numbers and only the exports format them
+for display (see display_items()). A Table saves the numeric columns as NumPy
+arrays, one .npy file each, which are memory-mapped when loaded again, and
+the other columns as JSON:
+
+    Table.from_items(prefectures).save('build/jp/tables/prefectures')
+    table = Table.load('build/jp/tables/prefectures')
+    table['stats_population'].sum()
+'''
+
+import json
+import os
+import shutil
+
+from pathlib import Path
+
+import numpy as np
+
+# How the exports show the statistics, as format() specs
+DISPLAY = {
+    'stats_population': ',d',
+    'stats_area': ',.2f',
+    'stats_population_density': ',.2f',
+}
+
+SCHEMA = 'columns.json'
+
+
+################################################################################
+def column_dtype(values):
+    '''
+    The NumPy type of a column of plain numbers, else None.
+    '''
+
+    if not values or any(isinstance(value, bool) or not isinstance(value, (int, float))
+                         for value in values):
+        return None
+
+    return 'int64' if all(isinstance(value, int) for value in values) else 'float64'
+
+
+################################################################################
+def display_items(items, formats=None):
+    '''
+    Copies of the items (a dict of dicts) with their numbers formatted for
+    display, by default as in DISPLAY.
+    '''
+
+    formats = DISPLAY if formats is None else formats
+
+    return {name: {column: format(value, formats[column])
+                   if column in formats and column_dtype([value]) else value
+                   for column, value in item.items()}
+            for name, item in items.items()}
+
+
+################################################################################
+class Table():
+    '''
+    The items of a stage by column, numeric columns as NumPy arrays.
+
+    `keys` name the rows. `columns` maps the column names to an array with a
+    value per row, or to a dict of the values of only the rows that have one.
+    '''
+
+    ############################################################################
+    def __init__(self, keys, columns):
+        self.keys = list(keys)
+        self.columns = dict(columns)
+
+    ############################################################################
+    @classmethod
+    def from_items(cls, items):
+        '''
+        The table of a dict of items, the columns in the order they appear.
+        '''
+
+        names = list(dict.fromkeys(column for item in items.values() for column in item))
+        columns = {}
+
+        for column in names:
+            values = [item[column] for item in items.values() if column in item]
+            dtype = column_dtype(values) if len(values) == len(items) else None
+
+            columns[column] = (np.array(values, dtype=dtype) if dtype else
+                               {key: item[column] for key, item in items.items()
+                                if column in item})
+
+        return cls(items, columns)
+
+    ############################################################################
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    ############################################################################
+    def __len__(self):
+        return len(self.keys)
+
+    ############################################################################
+    def items(self):
+        '''
+        The table as a dict of items with plain Python values.
+        '''
+
+        items = {key: {} for key in self.keys}
+
+        for column, values in self.columns.items():
+            if isinstance(values, dict):
+                for key, value in values.items():
+                    items[key][column] = value
+            else:
+                for key, value in zip(self.keys, values.tolist()):
+                    items[key][column] = value
+
+        return items
+
+    ############################################################################
+    def save(self, path):
+        '''
+        Write the table to the directory `path`, replacing an older one.
+        '''
+
+        path = Path(path)
+        tmppath = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+
+        shutil.rmtree(tmppath, ignore_errors=True)
+        tmppath.mkdir(parents=True)
+
+        schema = {'keys': self.keys, 'columns': list(self.columns),
+                  'arrays': [], 'values': {}}
+
+        for column, values in self.columns.items():
+            if isinstance(values, dict):
+                schema['values'][column] = values
+            else:
+                np.save(tmppath / f'{len(schema["arrays"])}.npy', values)
+                schema['arrays'].append(column)
+
+        (tmppath / SCHEMA).write_text(json.dumps(schema, ensure_ascii=False, default=str))
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmppath, path)
+
+    ############################################################################
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Read a table saved to `path`, memory-mapping the arrays with `mmap`.
+        '''
+
+        path = Path(path)
+        schema = json.loads((path / SCHEMA).read_text())
+
+        columns = {column: np.load(path / f'{idx}.npy', mmap_mode='r' if mmap else None)
+                   for idx, column in enumerate(schema['arrays'])}
+        columns.update(schema['values'])
+
+        return cls(schema['keys'], {column: columns[column] for column in schema['columns']})
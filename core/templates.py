@@ -0,0 +1,135 @@
+'''
+Render the card templates of the models from compiled layouts.
+
+A card is a layout (map, input block, answer block and the mode class of the
+map) filled into the card template of a deck. The card template is split into
+its text and slots once, and every rendered fragment is kept, keyed by its
+inputs: the models of all variants of a deck (marked or click cards, other
+maps or CSS) share one TemplateEngine and every combination of map and input
+is only rendered once per process.
+
+    ENGINE = TemplateEngine(CARD_TEMPLATE)
+    LAYOUTS = (CardLayout('Marked on Map', 'marked', MARK_INPUT, MARK_INPUT, ANSWER),)
+
+    model = ENGINE.model(conf['Region Model'], LAYOUTS, svg, css)
+
+With `thumbnails` the marked cards show the pre-rendered map of the note
+(see core.maps.map_thumbnails) from its `map_thumbnail` field instead.
+'''
+
+from collections import namedtuple
+from functools import lru_cache
+
+import genanki
+import regex
+
+from core.config import select_templates
+
+# The %(name)s slots of a card template
+SLOT = regex.compile(r'%\((\w+)\)s')
+
+# The field with the <img> of a note's thumbnail, shown in place of the map
+THUMBNAIL_FIELD = 'map_thumbnail'
+
+
+################################################################################
+class CardLayout(namedtuple('CardLayout', 'name, mode, front, back, answer')):
+    '''
+    A card template of a model.
+
+    `mode` is the class of the map (marked or click), `front` and `back` are
+    the input blocks of both sides and `answer` is only shown on the back.
+    '''
+
+    __slots__ = ()
+
+
+################################################################################
+class CompiledTemplate():
+    '''
+    A %(name)s template split into its text and slots once.
+    '''
+
+    ############################################################################
+    def __init__(self, text):
+        self.parts = SLOT.split(text)
+        self.slots = tuple(self.parts[1::2])
+
+    ############################################################################
+    def render(self, values):
+        '''
+        The template with the slots filled from the dict `values`.
+        '''
+
+        parts = list(self.parts)
+        parts[1::2] = [values[slot] for slot in self.slots]
+
+        return ''.join(parts)
+
+
+################################################################################
+class TemplateEngine():
+    '''
+    Render the card templates of a deck's models, each fragment once.
+    '''
+
+    ############################################################################
+    def __init__(self, card_template, cache_size=None):
+        self.card = CompiledTemplate(card_template)
+
+        # The maps are long strings, but a str keeps its hash once computed
+        self.side = lru_cache(maxsize=cache_size)(self._side)
+        self.template = lru_cache(maxsize=cache_size)(self._template)
+
+    ############################################################################
+    def _side(self, svg, mode, input_block, answer):
+        '''
+        One side of a card, the answer is empty on the front.
+        '''
+
+        return self.card.render({'svg': svg, 'input': input_block,
+                                 'answer': answer, 'template': mode})
+
+    ############################################################################
+    def _template(self, layout, svg):
+        '''
+        The genanki template of a layout with a map.
+        '''
+
+        return {
+            'name': layout.name,
+            'qfmt': self.side(svg, layout.mode, layout.front, ''),
+            'afmt': self.side(svg, layout.mode, layout.back, layout.answer),
+        }
+
+    ############################################################################
+    def templates(self, layouts, svg, names=None, thumbnails=False):
+        '''
+        The genanki templates of the layouts with a map, only the named ones
+        if `names` is given. With `thumbnails` the marked cards show the
+        thumbnail field instead of the map, the clicks need the map.
+        '''
+
+        maps = {'marked': '{{%s}}' % THUMBNAIL_FIELD} if thumbnails else {}
+
+        return select_templates([dict(self.template(layout, maps.get(layout.mode, svg)))
+                                 for layout in layouts], names)
+
+    ############################################################################
+    def model(self, model_conf, layouts, svg, css, names=None, thumbnails=False):
+        '''
+        A genanki model as configured in a model section of a deck JSON, with
+        the thumbnail field added if there are `thumbnails`.
+        '''
+
+        fields = model_conf['model_fields']
+
+        if thumbnails:
+            fields = fields + [{'name': THUMBNAIL_FIELD}]
+
+        return genanki.Model(
+            model_conf['model_id'],
+            model_conf['model_name'],
+            fields=fields,
+            templates=self.templates(layouts, svg, names, thumbnails),
+            css=css)
@@ -2,46 +2,543 @@
 Query WikiData for information and parse it into a DataFrame.
 '''
 
+import json
+import os
+import random
+import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
 import pandas as pd
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from core import profile
+from core.endpoint import is_transient, make_endpoint, normalize_query, query_key
+
+CACHE_DIR = Path(__file__).resolve().parent.parent / '.cache' / 'sparql'
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+XSD_INT = {XSD + name for name in (
+    'integer', 'int', 'long', 'short', 'byte',
+    'nonNegativeInteger', 'positiveInteger', 'nonPositiveInteger', 'negativeInteger',
+    'unsignedLong', 'unsignedInt', 'unsignedShort', 'unsignedByte')}
+XSD_FLOAT = {XSD + name for name in ('decimal', 'double', 'float')}
+XSD_DATETIME = {XSD + name for name in ('dateTime', 'date')}
+
+WHERE = re.compile(r'\bWHERE\s*\{', re.IGNORECASE)
+SELECT_VARS = re.compile(r'\bSELECT\s+(?:DISTINCT\s+|REDUCED\s+)?(.*?)\bWHERE\b',
+                         re.IGNORECASE | re.DOTALL)
+
 
 ################################################################################
-class WDQuery():  # pylint: disable=too-few-public-methods
+class OfflineError(LookupError):
     '''
-    Create a pandas DataFrame with information queried from Wikidata.
+    Raised when a query is not cached and the network must not be used.
+    '''
+
+
+################################################################################
+class QueryCache():
+    '''
+    Persistent on-disk cache for the JSON responses of SPARQL queries.
+
+    Entries are keyed on a hash of the whitespace-normalized query text and
+    served without any network access for `ttl` seconds. Stale entries are
+    revalidated with the ETag/Last-Modified headers of the original response,
+    so an unchanged result only costs a 304. The least recently used entries
+    are evicted once `max_entries` or `max_bytes` is exceeded. In `offline`
+    mode cached entries are served regardless of their age and a missing
+    entry raises an OfflineError.
+    '''
+
+    ############################################################################
+    def __init__(self, path=CACHE_DIR, ttl=7 * 24 * 3600, max_entries=256,
+                 max_bytes=256 * 2**20, offline=False):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        self.hits = 0
+        self.misses = 0
+
+    ############################################################################
+    @staticmethod
+    def normalize(query):
+        '''
+        Collapse all whitespace so that reformatting a query keeps its key.
+        '''
+
+        return normalize_query(query)
+
+    ############################################################################
+    @staticmethod
+    def key(query):
+        '''
+        The cache key of a query.
+        '''
+
+        return query_key(query)
+
+    ############################################################################
+    def load(self, key):
+        '''
+        Read a cache entry, None if it does not exist or is unreadable.
+        '''
+
+        try:
+            entry = json.loads((self.path / f'{key}.json').read_text())
+        except (OSError, ValueError):
+            return None
+
+        # Mark as recently used for the eviction order, it might be evicted meanwhile
+        try:
+            os.utime(self.path / f'{key}.json')
+        except OSError:
+            pass
+
+        return entry
+
+    ############################################################################
+    def store(self, key, entry):
+        '''
+        Atomically write a cache entry and evict old entries if necessary.
+        '''
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        tmppath = self.path / f'{key}.{os.getpid()}.tmp'
+        tmppath.write_text(json.dumps(entry, ensure_ascii=False))
+        os.replace(tmppath, self.path / f'{key}.json')
+
+        self.evict()
+
+    ############################################################################
+    def evict(self):
+        '''
+        Remove the least recently used entries until the limits are met.
+        '''
+
+        entries = []
+
+        for entry_path in self.path.glob('*.json'):
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        entries.sort(reverse=True)
+
+        total = 0
+
+        for count, (_, size, entry_path) in enumerate(entries, 1):
+            total += size
+
+            if count > self.max_entries or total > self.max_bytes:
+                entry_path.unlink(missing_ok=True)
+
+    ############################################################################
+    def fetch(self, query, endpoint=None):
+        '''
+        Get the JSON result of a query, from the cache if possible.
+
+        Misses are answered by `endpoint`, a backend from core.endpoint or a
+        URL, by default the one set with configure_endpoint().
+        '''
+
+        key = self.key(query)
+        entry = self.load(key)
+
+        if entry is not None and (
+                self.offline or time.time() - entry['fetched'] < self.ttl):
+            self.hits += 1
+            profile.count('sparql.cache_hits')
+            return entry['result']
+
+        if self.offline:
+            raise OfflineError(f'Query {key[:12]} is not cached, cannot run offline')
+
+        self.misses += 1
+        profile.count('sparql.cache_misses')
+
+        if endpoint is None:
+            endpoint = DEFAULT_ENDPOINT
+        elif isinstance(endpoint, str):
+            endpoint = make_endpoint(endpoint)
+
+        with profile.span('sparql'):
+            response = endpoint.query(query, *(
+                (entry.get('etag'), entry.get('last_modified')) if entry else ()))
+
+        if response.status == 304:
+            # Not modified, only refresh the age of the entry
+            profile.count('sparql.not_modified')
+            entry['fetched'] = time.time()
+            self.store(key, entry)
+
+            return entry['result']
+
+        entry = {
+            'query': self.normalize(query),
+            'fetched': time.time(),
+            'etag': response.etag,
+            'last_modified': response.last_modified,
+            'result': response.result,
+        }
+
+        self.store(key, entry)
+
+        return entry['result']
+
+
+DEFAULT_CACHE = QueryCache()
+DEFAULT_ENDPOINT = make_endpoint()
+
+
+################################################################################
+def column_kind(datatypes):
+    '''
+    The kind of column ('int', 'float', 'datetime' or 'str') that holds values
+    of the given XSD datatypes, plain literals and URIs (None) are strings.
+    '''
+
+    if not datatypes or None in datatypes:
+        return 'str'
+    if datatypes <= XSD_INT:
+        return 'int'
+    if datatypes <= XSD_INT | XSD_FLOAT:
+        return 'float'
+    if datatypes <= XSD_DATETIME:
+        return 'datetime'
+
+    return 'str'
+
+
+################################################################################
+def decode_columns(result):
+    '''
+    Split the bindings of a SPARQL JSON result into one column per variable.
+
+    Returns the columns of raw values (None where a variable is unbound) and
+    the kind of each column, derived from the datatypes of all its values.
+    '''
+
+    bindings = result['results']['bindings']
+    columns, kinds = {}, {}
+
+    for var in result['head']['vars']:
+        cells = [binding.get(var) for binding in bindings]
+
+        columns[var] = [cell['value'] if cell else None for cell in cells]
+        kinds[var] = column_kind({cell.get('datatype') for cell in cells if cell})
+
+    return columns, kinds
+
+
+################################################################################
+def convert_column(values, kind, parse_dates=False):
+    '''
+    Convert a column of raw values to Python values of its kind.
+    '''
+
+    if kind == 'int':
+        convert = int
+    elif kind == 'float':
+        convert = float
+    elif kind == 'datetime' and parse_dates:
+        convert = parse_datetime
+    else:
+        return values
+
+    return [None if value is None else convert(value) for value in values]
+
+
+################################################################################
+def parse_datetime(value):
+    '''
+    Parse an xsd:dateTime (or xsd:date) as returned by Wikidata.
+    '''
+
+    return pd.Timestamp(value).to_pydatetime()
+
+
+################################################################################
+def fold_bindings(result, key='name_en', parse_dates=False):
+    '''
+    Collect the bindings of a SPARQL JSON result per value of `key`.
+
+    Every variable maps to its single value, to the list of its distinct values
+    (in the order they were first seen) if there are several, or to None if
+    it is never bound. Rows without a `key` are dropped.
     '''
 
-    ENDPOINT_URL = 'https://query.wikidata.org/sparql'
+    columns, kinds = decode_columns(result)
+    keys = columns[key]
+
+    items = {item: {} for item in keys if item is not None}
+
+    for var, values in columns.items():
+        values = convert_column(values, kinds[var], parse_dates)
+
+        # Dicts as ordered sets, so that repeated values are folded in O(1)
+        seen = {item: {} for item in items}
+
+        for item, value in zip(keys, values):
+            if item is not None and value is not None:
+                seen[item][value] = None
+
+        for item, distinct in seen.items():
+            if not distinct:
+                items[item][var] = None
+            elif len(distinct) == 1:
+                items[item][var] = next(iter(distinct))
+            else:
+                items[item][var] = list(distinct)
+
+    return items
+
+
+################################################################################
+def configure_cache(**kwargs):
+    '''
+    Replace the cache shared by all queries, e.g. to go offline.
+    '''
+
+    global DEFAULT_CACHE  # pylint: disable=global-statement
+
+    DEFAULT_CACHE = QueryCache(**kwargs)
+
+    return DEFAULT_CACHE
+
+
+################################################################################
+def configure_endpoint(spec=None, latency=0.0):
+    '''
+    Replace the backend that answers the queries, see core.endpoint.make_endpoint().
+    '''
+
+    global DEFAULT_ENDPOINT  # pylint: disable=global-statement
+
+    DEFAULT_ENDPOINT = make_endpoint(spec, latency)
+
+    return DEFAULT_ENDPOINT
+
+
+################################################################################
+def sparql_term(binding):
+    '''
+    Write a value of a SPARQL JSON result as term of a query.
+    '''
+
+    if binding['type'] == 'uri':
+        return f'<{binding["value"]}>'
+
+    literal = json.dumps(binding['value'], ensure_ascii=False)
+
+    if 'xml:lang' in binding:
+        return f'{literal}@{binding["xml:lang"]}'
+    if 'datatype' in binding:
+        return f'{literal}^^<{binding["datatype"]}>'
+
+    return literal
+
+
+################################################################################
+def with_values(query, var, terms):
+    '''
+    Restrict a query to the given terms of a variable with a VALUES block.
+    '''
+
+    block = 'VALUES ?{} {{ {} }}'.format(var, ' '.join(terms))
+
+    return WHERE.sub(lambda match: f'{match.group(0)}\n    {block}\n', query, count=1)
+
+
+################################################################################
+def with_page(query, limit, offset):
+    '''
+    One page of a query, ordered by its projected variables so that the pages
+    do not overlap. Queries without either (e.g. SELECT *) cannot be paged.
+    '''
+
+    if not re.search(r'\bORDER\s+BY\b', query, re.IGNORECASE):
+        select = SELECT_VARS.search(query)
+        projection = re.sub(r'\(.*?\)', '', select.group(1)) if select else ''
+        variables = re.findall(r'\?\w+', projection)
+
+        if not variables:
+            raise ValueError('Paged queries need an ORDER BY or projected variables')
+
+        query += '\nORDER BY ' + ' '.join(variables)
+
+    return f'{query}\nLIMIT {limit} OFFSET {offset}'
+
+
+################################################################################
+def merge_results(results):
+    '''
+    Concatenate the bindings of SPARQL JSON results.
+    '''
+
+    variables = {}
+
+    for result in results:
+        variables.update(dict.fromkeys(result['head']['vars']))
+
+    return {
+        'head': {'vars': list(variables)},
+        'results': {'bindings': [binding for result in results
+                                 for binding in result['results']['bindings']]},
+    }
+
+
+################################################################################
+class WDQuery():
+    '''
+    Create a pandas DataFrame with information queried from Wikidata.
+    '''
 
     ############################################################################
-    def __init__(self, query):
+    def __init__(self, query, cache=None, endpoint=None, values=None, chunk_size=None,
+                 max_workers=4, retries=3, backoff=1.0):
+        '''
+        Large queries can be split into chunks of `chunk_size`: with `values`
+        as (variable, terms) a VALUES block restricts every chunk to some of
+        the terms, otherwise the result is fetched in LIMIT/OFFSET pages. Up to
+        `max_workers` chunks are in flight at once, failing chunks are retried
+        `retries` times with exponential backoff.
+        '''
+
         self.query = query
+        self.cache = cache if cache is not None else DEFAULT_CACHE
+        self.endpoint = endpoint
+        self.values = values
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
         self.data = pd.DataFrame()
 
     ############################################################################
-    def get_df(self):
+    def fetch(self, query):
+        '''
+        Get the result of a single query, retry transient errors.
+        '''
+
+        attempt = 0
+
+        while True:
+            try:
+                return self.cache.fetch(query, self.endpoint)
+            except Exception as err:  # pylint: disable=broad-except
+                if attempt >= self.retries or not is_transient(err):
+                    raise
+
+            time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    ############################################################################
+    def fetch_values(self):
+        '''
+        Get the result in chunks of the terms in `values`.
+        '''
+
+        var, terms = self.values
+        size = self.chunk_size or len(terms) or 1
+
+        queries = [with_values(self.query, var, terms[start:start + size])
+                   for start in range(0, len(terms), size)]
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            return merge_results(list(executor.map(self.fetch, queries)))
+
+    ############################################################################
+    def fetch_pages(self):
         '''
-        Get the result Wikidata.
+        Get the result page by page until a page is not full.
         '''
 
-        sparql = SPARQLWrapper(self.ENDPOINT_URL)
-        sparql.setQuery(self.query)
-        sparql.setReturnFormat(JSON)
+        pages = {}
+        running = {}
+        offset = 0
+        complete = False
 
-        result = sparql.query().convert()
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            while running or not complete:
+                while not complete and len(running) < self.max_workers:
+                    running[executor.submit(
+                        self.fetch, with_page(self.query, self.chunk_size, offset))] = offset
+                    offset += self.chunk_size
 
-        wd_df = pd.DataFrame(result['results']['bindings'])
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    page = running.pop(future)
+                    pages[page] = future.result()
+
+                    if len(pages[page]['results']['bindings']) < self.chunk_size:
+                        complete = True
+
+        return merge_results([pages[page] for page in sorted(pages)])
+
+    ############################################################################
+    def get_json(self):
+        '''
+        Get the raw JSON result from Wikidata (or the cache).
+        '''
+
+        if self.values is not None:
+            return self.fetch_values()
+        if self.chunk_size:
+            return self.fetch_pages()
+
+        return self.fetch(self.query)
+
+    ############################################################################
+    def get_terms(self, var):
+        '''
+        Get the distinct values of a variable as query terms, e.g. for `values`.
+        '''
+
+        return list(dict.fromkeys(
+            sparql_term(binding[var])
+            for binding in self.get_json()['results']['bindings'] if var in binding))
+
+    ############################################################################
+    def get_items(self, key='name_en', parse_dates=False):
+        '''
+        Get the result from Wikidata as dict per value of `key`.
+        '''
+
+        result = self.get_json()
+
+        with profile.span('decode'):
+            return fold_bindings(result, key, parse_dates)
+
+    ############################################################################
+    def get_df(self):
+        '''
+        Get the result from Wikidata with typed numeric columns.
+
+        Dates stay the strings Wikidata returns (e.g. 2019-10-01T00:00:00Z),
+        they end up in the note fields as they are.
+        '''
 
-        # wd_dtypes = wd_df.applymap(
-        #     lambda x: x.get('datatype', None) if isinstance(x, dict) else None)
+        result = self.get_json()
 
-        # float_cols = wd_dtypes.columns[
-        #     (wd_dtypes == 'http://www.w3.org/2001/XMLSchema#decimal').all()]
+        with profile.span('decode'):
+            columns, kinds = decode_columns(result)
 
-        wd_df = wd_df.applymap(
-            lambda x: (x['value'] if isinstance(x, dict) else None))
+            wd_df = pd.DataFrame(columns, columns=list(columns))
 
-        # wd_df = wd_df.astype({colname: 'float' for colname in float_cols})
+            for var, kind in kinds.items():
+                if kind == 'int':
+                    wd_df[var] = pd.to_numeric(wd_df[var]).astype('Int64')
+                elif kind == 'float':
+                    wd_df[var] = pd.to_numeric(wd_df[var]).astype('float64')
 
         return wd_df
@@ -1,143 +1,252 @@
 #! /usr/bin/env python3
 
+'''
+Extract the tables of Wikipedia list pages to JSON.
+
+Every page is described by a Page: the URL, the output file, which sortable
+table to take, which columns are numbers and whether the links of the cells
+are kept. The first column keys the rows. The pages are fetched concurrently
+over one session and parsed with lxml, html5lib (much slower) is only used if
+lxml is missing.
+'''
+
 import argparse
 import json
-import regex
-import requests
 
-from collections import defaultdict
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urljoin
+
+from core.names import clean_cell
+from core.session import make_session
 
-from bs4 import BeautifulSoup
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
 
 WIKI_URL = 'https://en.wikipedia.org'
 PREF_URL = 'https://en.wikipedia.org/wiki/Prefectures_of_Japan'
 CAPS_URL = 'https://en.wikipedia.org/wiki/List_of_capitals_in_Japan'
 
+SORTABLE = "//table[contains(concat(' ', normalize-space(@class), ' '), ' sortable ')]"
+
+# Footnote marks and the hidden sort keys (e.g. KobeKobe) are not cell content
+NOISE = (".//sup[contains(concat(' ', normalize-space(@class), ' '), ' reference ')]"
+         "|.//*[contains(concat(' ', normalize-space(@class), ' '), ' sortkey ')]"
+         "|.//*[contains(translate(@style, ' ', ''), 'display:none')]")
+NOISE_CSS = 'sup.reference, .sortkey, [style*="display:none"], [style*="display: none"]'
+
+# A cell as (text, link targets, colspan, rowspan, whether it is a <th>)
+Cell = namedtuple('Cell', 'text, links, colspan, rowspan, head')
+
+Page = namedtuple('Page', 'url, outfile, table, types, links')
+Page.__new__.__defaults__ = (0, {}, False)
+
+PAGES = {
+    'prefs': Page(PREF_URL, 'data/prefs.json',
+                  types={'Population': int, 'Area': float, 'Density': float}),
+    'caps': Page(CAPS_URL, 'data/caps.json', types={'Pop.': int}, links=True),
+}
+
 ################################################################################
 def superstrip(string):
-    del_chars = '¹²³'
+    return clean_cell(string)
+################################################################################
+
+################################################################################
+def span(value):
+    '''A colspan or rowspan attribute, 1 if missing or broken.'''
 
-    string = regex.sub('|'.join(del_chars), '', string.strip())
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+################################################################################
 
-    sub_chars = [('ū', 'u'), ('ō', 'o')]
+################################################################################
+def lxml_tables(html):
+    '''The rows of cells of all sortable tables, parsed by lxml.'''
 
-    for schar in sub_chars:
-        string = regex.sub(*schar, string)
+    tree = lxml.html.fromstring(html)
 
-    return string
+    for table in tree.xpath(SORTABLE):
+        for node in table.xpath(NOISE):
+            node.drop_tree()
+
+        yield [[Cell(cell.text_content(), cell.xpath('.//a/@href'),
+                     span(cell.get('colspan')), span(cell.get('rowspan')),
+                     cell.tag == 'th')
+                for cell in row.xpath('./th|./td')]
+               for row in table.xpath('./tr|./thead/tr|./tbody/tr|./tfoot/tr')]
 ################################################################################
 
 ################################################################################
-def postprocess(result):
-    for pref, item in result.items():
-        try:
-            item['Population'] = int(
-                    regex.sub(',', '', item['Population']))
-            item['Area'] = float(
-                    regex.sub(',', '', item['Area']))
-            item['Density'] = float(
-                    regex.sub(',', '', item['Density']))
-        except KeyError:
-            pass
+def html5lib_tables(html):
+    '''The rows of cells of all sortable tables, parsed by html5lib.'''
 
-        try:
-            item['Pop.'] = int(
-                    regex.sub(',', '', item['Pop.']))
-        except KeyError:
-            pass
+    # Only needed without lxml, keep the import cheap otherwise
+    from bs4 import BeautifulSoup  # pylint: disable=import-outside-toplevel
 
-    return result
+    soup = BeautifulSoup(html, 'html5lib')
+
+    for table in soup.select('table.sortable'):
+        for node in table.select(NOISE_CSS):
+            node.decompose()
+
+        yield [[Cell(cell.text, [a['href'] for a in cell.find_all('a', href=True)],
+                     span(cell.get('colspan')), span(cell.get('rowspan')),
+                     cell.name == 'th')
+                for cell in row.find_all(['th', 'td'], recursive=False)]
+               for row in table.select(':scope > tr, :scope > * > tr')]
 ################################################################################
 
 ################################################################################
-def fetch_prefectures():
-    header = []
-    result = defaultdict(dict)
+def parse_tables(html):
+    return lxml_tables(html) if lxml is not None else html5lib_tables(html)
+################################################################################
+
+################################################################################
+def expand_spans(rows):
+    '''Repeat the cells spanning several columns or rows, in a grid.'''
 
-    req = requests.get(PREF_URL)
+    grid = []
+    pending = {}  # Column -> (rows left, cell) of the cells spanning down
 
-    html = req.content.decode("utf-8")
-    soup = BeautifulSoup(html, "html5lib")
+    for row in rows:
+        cells = iter(row)
+        line = []
 
-    table = soup.select('table.sortable')[0]
+        while True:
+            col = len(line)
 
-    for th in table.find_all('th'):
-        header.append(superstrip(th.text))
+            if col in pending:
+                left, cell = pending[col]
+                line.append(cell)
 
-    curr_pos = 0
-    curr_pref = None
+                if left > 1:
+                    pending[col] = (left - 1, cell)
+                else:
+                    del pending[col]
+                continue
 
-    for td in table.find_all('td'):
-        text = superstrip(td.text)
+            cell = next(cells, None)
 
-        if curr_pos == 0:
-            curr_pref = text
+            if cell is None:
+                break
 
-        result[curr_pref][header[curr_pos]] = text
+            for _ in range(cell.colspan):
+                if cell.rowspan > 1:
+                    pending[len(line)] = (cell.rowspan - 1, cell)
 
-        curr_pos += 1
-        if curr_pos == len(header):
-            curr_pos = 0
+                line.append(cell)
 
-    result = postprocess(result)
+        grid.append(line)
 
-    with open('data/prefs.json', 'w') as outfile:
-        json.dump(result, outfile, ensure_ascii=False, indent=4)
+    return grid
 ################################################################################
 
 ################################################################################
-def fetch_capitals():
-    # TODO: Footnote and link of Shinjuku is broken
-    #       Some city names appear twice (KobeKobe)
+def extract_table(rows, page):
+    '''The rows of a table as dicts of the header's columns, keyed by the first.'''
+
+    grid = expand_spans(rows)
+
+    # The header is the last of the leading rows that have no data cells
     header = []
-    result = defaultdict(dict)
 
-    req = requests.get(CAPS_URL)
+    while grid and all(cell.head for cell in grid[0]):
+        header = [superstrip(cell.text) for cell in grid.pop(0)]
+
+    result = {}
+
+    for line in grid:
+        if not header or len(line) < len(header):
+            continue
+
+        item = {}
+
+        for column, cell in zip(header, line):
+            item[column] = superstrip(cell.text)
+
+            links = [link for link in cell.links if not link.startswith('#')]
+
+            if page.links and links:
+                item[column + '_a'] = urljoin(WIKI_URL, links[-1])
+
+        for column, convert in page.types.items():
+            if column in item:
+                item[column] = convert(item[column].replace(',', ''))
 
-    html = req.content.decode("utf-8")
-    soup = BeautifulSoup(html, "html5lib")
+        result[item[header[0]]] = item
 
-    table = soup.select('table.sortable')[0]
+    return result
+################################################################################
+
+################################################################################
+def fetch_page(session, page):
+    '''The rows of the table of a page.'''
+
+    req = session.get(page.url, timeout=60)
+    req.raise_for_status()
 
-    for th in table.find_all('th'):
-        header.append(superstrip(th.text))
+    tables = list(parse_tables(req.content.decode('utf-8')))
 
-    curr_pos = 0
-    curr_pref = None
+    return extract_table(tables[page.table], page)
+################################################################################
 
-    for td in table.find_all('td'):
-        text = superstrip(td.text)
+################################################################################
+def fetch_pages(pages, max_workers=4):
+    '''Fetch and extract several pages at once, write their JSON files.'''
 
-        if curr_pos == 0:
-            curr_pref = text
+    with make_session(pool_size=max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(lambda page: fetch_page(session, page), pages)
 
-        result[curr_pref][header[curr_pos]] = text
+        for page, result in zip(pages, results):
+            Path(page.outfile).parent.mkdir(parents=True, exist_ok=True)
 
-        for a in td.find_all('a'):
-            result[curr_pref][header[curr_pos]+'_a'] = \
-                WIKI_URL + a['href']
+            with open(page.outfile, 'w') as outfile:
+                json.dump(result, outfile, ensure_ascii=False, indent=4)
 
-        curr_pos += 1
-        if curr_pos == len(header):
-            curr_pos = 0
+            print(f'{page.url}: {len(result)} rows -> {page.outfile}')
+################################################################################
+
+################################################################################
+def parse_types(specs):
+    '''The column types of COLUMN=int|float arguments.'''
 
-    result = postprocess(result)
+    converters = {'int': int, 'float': float}
 
-    with open('data/caps.json', 'w') as outfile:
-        json.dump(result, outfile, ensure_ascii=False, indent=4)
+    return {column: converters[kind]
+            for column, kind in (spec.rsplit('=', 1) for spec in specs)}
 ################################################################################
 
 ################################################################################
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--pref", action='store_true')
-    parser.add_argument("--caps", action='store_true')
+    parser.add_argument('--pref', action='store_true')
+    parser.add_argument('--caps', action='store_true')
+    parser.add_argument('--pages', nargs='+', choices=PAGES, default=[],
+                        help='fetch these of the known pages')
+    parser.add_argument('--url', nargs=2, action='append', default=[],
+                        metavar=('URL', 'OUTFILE'),
+                        help='fetch the table of any other list page to OUTFILE')
+    parser.add_argument('--table', type=int, default=0,
+                        help='take the n-th sortable table of the --url pages')
+    parser.add_argument('--types', nargs='+', default=[], metavar='COLUMN=int|float',
+                        help='convert these columns of the --url pages')
+    parser.add_argument('--links', action='store_true',
+                        help='keep the links of the cells of the --url pages')
+    parser.add_argument('--jobs', type=int, default=4)
 
     args = parser.parse_args()
 
-    if args.pref:
-        fetch_prefectures()
+    names = args.pages + ['prefs'] * args.pref + ['caps'] * args.caps
+    selected = [PAGES[name] for name in dict.fromkeys(names)]
+    selected += [Page(url, outfile, args.table, parse_types(args.types), args.links)
+                 for url, outfile in args.url]
 
-    if args.caps:
-        fetch_capitals()
+    fetch_pages(selected, args.jobs)
@@ -6,110 +6,65 @@
 
 import argparse
 import csv
+import io
 import json
 
-from collections import defaultdict
+from functools import partial
 from operator import itemgetter
 from pathlib import Path
 
-import genanki
-import regex
+from core import profile
+from core.apkg import item_table, select_rows
+from core.asyncquery import QueryRunner
+from core.buildstate import write_if_changed, write_package
+from core.geometry import map_index
+from core.images import image_jobs, img_tag, prepare_images
+from core.maps import map_thumbnails
+from core.names import NameNormalizer
+from core.pipeline import Pipeline, Stage
+from core.ranking import rank_items
+from core.tables import Table, display_items
+from core.templates import THUMBNAIL_FIELD
+from core.wikidata import configure_cache, configure_endpoint
+from jp import models_jp
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+# The files of the deck are next to this module, wherever it is run from
+HERE = Path(__file__).resolve().parent
 
-from models import PREF_DECK, REG_MODEL, PREF_MODEL
+# All queries of the deck are in flight at once, sharing one HTTP session
+QUERIES = QueryRunner()
 
-ENDPOINT_URL = 'https://query.wikidata.org/sparql'
+# What build() exports by default
+TARGETS = ('regions', 'prefectures', 'capitals')
 
+# Titles, map IDs, romaji and aliases of the names, each computed once
+NAMES = NameNormalizer()
 
-###############################################################################
-def json_extract(jsdict):
-    '''Interpret the Wikidata results.'''
-
-    result = defaultdict(dict)
-
-    keys = jsdict['head']['vars']
-
-    # TODOS: use first hit instead of overwriting in dict
-
-    for line in jsdict['results']['bindings']:
-        for key in keys:
-            item = line['name_en']['value']
-
-            try:
-                value = line[key]['value']
-            except KeyError:
-                result[item][key] = None
-                continue
-
-            if ('datatype' in line[key] and
-                    line[key]['datatype'] ==
-                    'http://www.w3.org/2001/XMLSchema#decimal'):
-                value = float(value)
-
-            if key in result[item] and result[item][key] != value:
-                if (isinstance(result[item][key], list) and
-                        value not in result[item][key]):
-                    result[item][key].append(value)
-                else:
-                    result[item][key] = [result[item][key], value]
-            else:
-                result[item][key] = value
-
-    return result
-###############################################################################
 
 ###############################################################################
 def strip_to_name(name):
     '''Replace unnecessary parts of the Wikidata results.'''
 
-    return regex.sub(r'\s+Prefecture|\s+\(?region\)?', '', name)
+    return NAMES.title(name)
 ###############################################################################
 
 ###############################################################################
 def as_map_id(name):
     '''Aggressively strip everthing that might trip Kitsun.'''
 
-    patterns = [
-        ('ū', 'u'),
-        ('Ō', 'O'),
-        ('ō', 'o')]
-
-    result = strip_to_name(name)
-
-    for pattern in patterns:
-        result = regex.sub(*pattern, result)
-
-    return result
+    return NAMES.map_id(name)
 
 ###############################################################################
 def as_romaji(name):
     '''Replace strange characters coming from Wikipedia.'''
 
-    patterns = [
-        ('ū', 'uu'),
-        ('Ō', 'Oo'),
-        ('ō', 'ou')]
-
-    result = strip_to_name(name)
-
-    for pattern in patterns:
-        result = regex.sub(*pattern, result)
-
-    return result
+    return NAMES.romaji(name)
 
 ###############################################################################
 def all_representations(wiki_name):
     '''Collect all string representations in a single line.'''
 
-    names = [strip_to_name(wiki_name)]
-
-    if as_map_id(names[0]) not in names:
-        names.append(as_map_id(names[0]))
-    if as_romaji(names[0]) not in names:
-        names.append(as_romaji(names[0]))
-
-    return ', '.join(names)
+    return NAMES.aliases(wiki_name)
 
 ###############################################################################
 def fix_urls(dic):
@@ -128,25 +83,31 @@ def fix_urls(dic):
 ###############################################################################
 
 ###############################################################################
-def process_regions():
-    '''
-    Collect all information for the regions of Japan.
-    '''
+async def query_wikidata(name):
+    '''Run one of the queries in sparql/ and interpret the results.'''
 
-    with open('json/prefectures.json', 'r') as infile:
-        db_prefs = json.load(infile)
+    query = (HERE / 'sparql' / f'{name}.rq').read_text()
 
-    query = Path('sparql/regions.rq').read_text()
+    return await QUERIES.get_items(query, chunk_size=models_jp.QUERY_CHUNK_SIZE)
 
-    sparql = SPARQLWrapper(ENDPOINT_URL)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
+###############################################################################
 
-    regions = json_extract(sparql.query().convert())
+###############################################################################
+def check_map_ids(items):
+    '''Make sure the map IDs of the items are all on the map.'''
 
-    # Hokkaido only has a single prefecture, fix to list
-    regions['Hokkaidō (region)']['prefecture_en'] = [
-        regions['Hokkaidō (region)']['prefecture_en']]
+    map_index(models_jp.JP_MAP).check(item['map_ids'] for item in items.values())
+
+###############################################################################
+def process_regions(regions, prefectures):
+    '''
+    Collect all information for the regions of Japan.
+    '''
+
+    # A region with a single prefecture (Hokkaido) is not folded to a list
+    for ritem in regions.values():
+        if isinstance(ritem['prefecture_en'], str):
+            ritem['prefecture_en'] = [ritem['prefecture_en']]
 
     ###########################################################################
     # Get the information from the prefectures ...
@@ -163,37 +124,23 @@ def process_regions():
             as_map_id(pref) for pref in ritem['prefecture_en'])
 
         for pref in ritem['prefecture_en']:
-            population += db_prefs[pref]['stats_population_f']
-            area += db_prefs[pref]['stats_area_f']
+            population += prefectures[pref]['stats_population']
+            area += prefectures[pref]['stats_area']
 
         regions[region]['stats_population'] = population
         regions[region]['stats_area'] = area
     ###########################################################################
 
     ###########################################################################
-    regs_by_popu = sorted(regions.values(),
-                          key=itemgetter('stats_population'),
-                          reverse=True)
-    regs_by_area = sorted(regions.values(),
-                          key=itemgetter('stats_area'),
-                          reverse=True)
-
     for _, ritem in regions.items():
-        ritem['stats_population_density'] = '{:,.2f}'.format(
-            ritem['stats_population']/ritem['stats_area'])
-        ritem['stats_population_rank'] = list(
-            map(itemgetter('name_kanji'), regs_by_popu)).index(
-                ritem['name_kanji']) + 1
-        ritem['stats_area_rank'] = list(
-            map(itemgetter('name_kanji'), regs_by_area)).index(
-                as_map_id(ritem['name_kanji'])) + 1
+        ritem['stats_population_density'] = ritem['stats_population'] / ritem['stats_area']
 
+    rank_items(regions, ['stats_population', 'stats_area'])
+
+    for _, ritem in regions.items():
         ritem['index'] = ritem['stats_population_rank'] * 100
         ritem['tags'] = ('Region',)
 
-        ritem['stats_population'] = '{:,d}'.format(int(ritem['stats_population']))
-        ritem['stats_area'] = '{:,.2f}'.format(ritem['stats_area'])
-
         del ritem['prefecture_en']
     ###########################################################################
 
@@ -204,8 +151,26 @@ def process_regions():
     regions['Kyūshū (region)']['url_wikipedia'] = 'https://en.wikipedia.org/wiki/Kyushu'
     ###########################################################################
 
-    with open('json/regions.json', 'w') as outfile:
-        json.dump(regions, outfile, ensure_ascii=False, indent=4)
+    return regions
+###############################################################################
+
+###############################################################################
+def export_regions(regions, outdir=HERE, check=True):
+    '''
+    Write the regions to the JSON and CSV files in `outdir`, return the notes
+    for the deck. With `check` all map IDs have to be on the map.
+    '''
+
+    if check:
+        check_map_ids(regions)
+
+    # The numbers stay typed in the tables, the exports show them formatted
+    Table.from_items(regions).save(f'{outdir}/tables/regions')
+
+    regions = display_items(regions)
+
+    write_if_changed(f'{outdir}/json/regions.json',
+                     json.dumps(regions, ensure_ascii=False, indent=4))
 
     fieldnames = [
         'index', 'title',
@@ -216,87 +181,84 @@ def process_regions():
         'url_wikipedia',
         'tags']
 
-    # Write the Anki deck
-    for _, fields in regions.items():
-        PREF_DECK.add_note(
-            genanki.Note(
-                model=REG_MODEL,
-                fields=[str(fields[fieldname]) for fieldname in fieldnames
-                        if fieldname not in ('tags',)],
-                tags=fields['tags'],
-                guid=fields['index']))
+    # The notes for the Anki deck, the package is written in build()
+    notes = item_table(regions.values(), fieldnames)
 
     # Write the CSV file
-    with open('csv/regions.csv', 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    csvfile = io.StringIO()
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+    regions = fix_urls(regions)
 
-        regions = fix_urls(regions)
+    writer.writeheader()
+    writer.writerows(sorted(regions.values(), key=itemgetter('index')))
 
-        writer.writeheader()
-        writer.writerows(sorted(regions.values(), key=itemgetter('index')))
+    write_if_changed(f'{outdir}/csv/regions.csv', csvfile.getvalue())
+
+    return notes
 ###############################################################################
 
 ###############################################################################
-def process_prefectures(preprocess=False):
+def process_prefectures(prefectures):
     '''
     Collect all information for the prefectures of Japan.
-    '''
-
-    with open('json/regions.json', 'r') as infile:
-        db_regs = json.load(infile)
-
-    query = Path('sparql/prefectures.rq').read_text()
 
-    sparql = SPARQLWrapper(ENDPOINT_URL)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-
-    prefectures = json_extract(sparql.query().convert())
-
-    prefs_by_popu = sorted(prefectures.values(),
-                           key=itemgetter('stats_population'),
-                           reverse=True)
-    prefs_by_area = sorted(prefectures.values(),
-                           key=itemgetter('stats_area'),
-                           reverse=True)
+    The index depends on the regions and is assigned in index_prefectures().
+    '''
 
     for _, pitem in prefectures.items():
-        reg_index = db_regs[pitem['in_region']]['index']
-
         pitem['title'] = strip_to_name(pitem['name_en'])
         pitem['map_ids'] = as_map_id(pitem['name_en'])
 
         pitem['name_en'] = all_representations(pitem['name_en'])
-        pitem['in_region'] = strip_to_name(pitem['in_region'])
 
-        pitem['stats_population_f'] = pitem['stats_population']
-        pitem['stats_population'] = '{:,d}'.format(int(pitem['stats_population']))
+        # The numbers are only formatted for display by the export
+        pitem['stats_population'] = int(pitem['stats_population'])
+        pitem['stats_population_density'] = pitem['stats_population'] / pitem['stats_area']
 
-        pitem['stats_area_f'] = pitem['stats_area']
-        pitem['stats_area'] = '{:,.2f}'.format(pitem['stats_area'])
+    rank_items(prefectures, ['stats_population', 'stats_area'])
 
-        pitem['stats_population_density'] = '{:,.2f}'.format(
-            pitem['stats_population_f']/ pitem['stats_area_f'])
+    prefectures['Hokkaidō Prefecture']['url_wikipedia'] = 'https://en.wikipedia.org/wiki/Hokkaido'
 
-        pitem['stats_population_rank'] = list(
-            map(itemgetter('name_kanji'), prefs_by_popu)).index(
-                as_map_id(pitem['name_kanji'])) + 1
-        pitem['stats_area_rank'] = list(
-            map(itemgetter('name_kanji'), prefs_by_area)).index(
-                as_map_id(pitem['name_kanji'])) + 1
+    return prefectures
+###############################################################################
+
+###############################################################################
+def index_prefectures(prefectures, regions):
+    '''
+    Order the prefectures after the rank of their region.
+    '''
+
+    prefectures = {name: dict(pitem) for name, pitem in prefectures.items()}
+
+    for _, pitem in prefectures.items():
+        reg_index = regions[pitem['in_region']]['index']
+
+        pitem['in_region'] = strip_to_name(pitem['in_region'])
 
         pitem['index'] = reg_index + pitem['stats_population_rank'] * 2
         pitem['tags'] = ('Prefecture', as_map_id(pitem['in_region']))
 
-    prefectures['Hokkaidō Prefecture']['url_wikipedia'] = 'https://en.wikipedia.org/wiki/Hokkaido'
+    return prefectures
+###############################################################################
+
+###############################################################################
+def export_prefectures(prefectures, outdir=HERE, check=True):
+    '''
+    Write the prefectures to the JSON and CSV files in `outdir`, return the
+    notes for the deck. With `check` all map IDs have to be on the map.
+    '''
+
+    if check:
+        check_map_ids(prefectures)
+
+    # The numbers stay typed in the tables, the exports show them formatted
+    Table.from_items(prefectures).save(f'{outdir}/tables/prefectures')
 
-    with open('json/prefectures.json', 'w') as outfile:
-        json.dump(prefectures, outfile, ensure_ascii=False, indent=4)
+    prefectures = display_items(prefectures)
 
-    if preprocess:
-        # We only write the JSON file to fix the indices of the regions while
-        # preprocessing the data. Also, we need the stats beforehand.
-        return
+    write_if_changed(f'{outdir}/json/prefectures.json',
+                     json.dumps(prefectures, ensure_ascii=False, indent=4))
 
     fieldnames = [
         'index', 'title',
@@ -309,49 +271,30 @@ def process_prefectures(preprocess=False):
         'img_flag', 'img_symbol',
         'tags']
 
-    # Export the numerical values to the JSON only
-    for pitem in prefectures.values():
-        del pitem['stats_population_f']
-        del pitem['stats_area_f']
-
-    # Write the Anki deck
-    for _, fields in prefectures.items():
-        PREF_DECK.add_note(
-            genanki.Note(
-                model=PREF_MODEL,
-                fields=[str(fields[fieldname]) for fieldname in fieldnames
-                        if fieldname not in ('tags',)],
-                tags=fields['tags'],
-                guid=fields['index']))
+    prefectures = fix_urls(prefectures)
+
+    # The notes for the Anki deck, the package is written in build()
+    notes = item_table(prefectures.values(), fieldnames)
 
     # Write the CSV file
-    with open('csv/prefectures.csv', 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    csvfile = io.StringIO()
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+    writer.writeheader()
+    writer.writerows(sorted(prefectures.values(), key=itemgetter('index')))
 
-        prefectures = fix_urls(prefectures)
+    write_if_changed(f'{outdir}/csv/prefectures.csv', csvfile.getvalue())
 
-        writer.writeheader()
-        writer.writerows(sorted(prefectures.values(), key=itemgetter('index')))
+    return notes
 ###############################################################################
 
 
 ###############################################################################
-def process_capitals():
+def process_capitals(capitals, prefectures):
     '''
     Collect all information for the capitals of Japan.
     '''
 
-    query = Path('sparql/capitals.rq').read_text()
-
-    sparql = SPARQLWrapper(ENDPOINT_URL)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-
-    capitals = json_extract(sparql.query().convert())
-
-    with open('json/prefectures.json', 'r') as infile:
-        db_prefs = json.load(infile)
-
     for _, citem in capitals.items():
         pref_name = as_map_id(citem['in_prefecture'])
 
@@ -360,7 +303,7 @@ def process_capitals():
             pref_name, as_map_id(citem['name_en']))])
 
         citem['name_en'] = all_representations(citem['name_en'])
-        citem['index'] = db_prefs[citem['in_prefecture']]['index'] + 1
+        citem['index'] = prefectures[citem['in_prefecture']]['index'] + 1
 
         citem['in_prefecture'] = strip_to_name(citem['in_prefecture'])
         citem['stats_population'] = int(citem['stats_population'])
@@ -369,10 +312,7 @@ def process_capitals():
         if citem['stats_area'] > 10**7:
             citem['stats_area'] /= 10**6
 
-        citem['stats_population_density'] = '{:,.2f}'.format(
-            citem['stats_population']/ citem['stats_area'])
-        citem['stats_population'] = '{:,d}'.format(int(citem['stats_population']))
-        citem['stats_area'] = '{:,.2f}'.format(citem['stats_area'])
+        citem['stats_population_density'] = citem['stats_population'] / citem['stats_area']
 
         # Only keep the first image, it should have the highest priority in Wikidata
         for key in ('url_official', 'img_impression'):
@@ -381,8 +321,26 @@ def process_capitals():
 
         citem['tags'] = ('Capital', as_map_id(citem['in_prefecture']))
 
-    with open('json/capitals.json', 'w') as outfile:
-        json.dump(capitals, outfile, ensure_ascii=False, indent=4)
+    return capitals
+###############################################################################
+
+###############################################################################
+def export_capitals(capitals, outdir=HERE, check=True):
+    '''
+    Write the capitals to the JSON and CSV files in `outdir`. With `check`
+    all map IDs have to be on the map.
+    '''
+
+    if check:
+        check_map_ids(capitals)
+
+    # The numbers stay typed in the tables, the exports show them formatted
+    Table.from_items(capitals).save(f'{outdir}/tables/capitals')
+
+    capitals = display_items(capitals)
+
+    write_if_changed(f'{outdir}/json/capitals.json',
+                     json.dumps(capitals, ensure_ascii=False, indent=4))
 
     fieldnames = [
         'index', 'title',
@@ -397,15 +355,183 @@ def process_capitals():
     # TODOS: write the Anki file ...
 
     # Write the CSV file
-    with open('csv/capitals.csv', 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    csvfile = io.StringIO()
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+    capitals = fix_urls(capitals)
+
+    writer.writeheader()
+    writer.writerows(sorted(capitals.values(), key=itemgetter('index')))
+
+    write_if_changed(f'{outdir}/csv/capitals.csv', csvfile.getvalue())
+###############################################################################
+
+###############################################################################
+def localize_images(items, itypes, refresh=False):
+    '''
+    Replace the image URLs with rasterized local copies shipped as media.
+    '''
+
+    items = {name: dict(item) for name, item in items.items()}
+    jobs = {}
+
+    for itype in itypes:
+        for name, item in items.items():
+            # Only keep the first image, it should have the highest priority
+            if isinstance(item.get(itype), list):
+                item[itype] = item[itype][0]
+
+        jobs[itype] = dict(zip(
+            [name for name, item in items.items() if item.get(itype)],
+            image_jobs(((name, item.get(itype)) for name, item in items.items()),
+                       itype[len('img_'):], HERE / 'img' / 'src', HERE / 'img' / 'png')))
+
+    pngpaths = prepare_images((job for itype_jobs in jobs.values()
+                               for job in itype_jobs.values()), refresh=refresh)
+
+    for itype, itype_jobs in jobs.items():
+        for name, job in itype_jobs.items():
+            items[name][itype] = job.pngpath.name
+
+    return items, sorted(set(map(str, pngpaths)))
+###############################################################################
+
+###############################################################################
+def region_notes(notes, region):
+    '''
+    The notes of a region (its map ID) and of its prefectures.
+    '''
+
+    # The region is tagged on its prefectures, the region notes have its title
+    return select_rows(notes, [as_map_id(title) == region or region in tags
+                               for title, tags in zip(notes['title'], notes['tags'])])
+###############################################################################
+
+###############################################################################
+def add_thumbnails(notes, prefix=''):
+    '''
+    Render the map of every note with its map IDs marked, return the notes
+    with the thumbnails and the paths of the PNGs.
+    '''
 
-        capitals = fix_urls(capitals)
+    pngpaths = map_thumbnails(
+        ((prefix + as_map_id(title), map_ids)
+         for title, map_ids in zip(notes['title'], notes['map_ids'])),
+        models_jp.JP_MAP, HERE / 'img' / 'thumbnails', models_jp.MINIFY_MAP,
+        models_jp.REGION_IDS)
 
-        writer.writeheader()
-        writer.writerows(sorted(capitals.values(), key=itemgetter('index')))
+    return (dict(notes, **{THUMBNAIL_FIELD: [img_tag(path, 360) for path in pngpaths]}),
+            pngpaths)
 ###############################################################################
 
+###############################################################################
+def make_pipeline(images=False, refresh=False, outdir=HERE):
+    '''
+    The region statistics are aggregated from the prefectures, while the index
+    of a prefecture depends on the rank of its region. Every stage runs once,
+    the capitals are fetched while the regions are aggregated.
+    '''
+
+    stages = [
+        Stage(partial(query_wikidata, 'regions'), name='query_regions',
+              outputs=('regions_raw',)),
+        Stage(partial(query_wikidata, 'prefectures'), name='query_prefectures',
+              outputs=('prefectures_raw',)),
+        Stage(partial(query_wikidata, 'capitals'), name='query_capitals',
+              outputs=('capitals_raw',)),
+
+        Stage(process_prefectures, inputs=('prefectures_raw',),
+              outputs=('prefectures_stats',)),
+        Stage(process_regions, inputs=('regions_raw', 'prefectures_stats'),
+              outputs=('regions',)),
+        Stage(index_prefectures, inputs=('prefectures_stats', 'regions'),
+              outputs=('prefectures',)),
+        Stage(process_capitals, inputs=('capitals_raw', 'prefectures'),
+              outputs=('capitals',)),
+
+        Stage(partial(export_regions, outdir=outdir), name='export_regions',
+              inputs=('regions',)),
+    ]
+
+    if images:
+        stages += [
+            Stage(partial(localize_images, itypes=('img_flag', 'img_symbol'),
+                          refresh=refresh),
+                  name='images_prefectures', inputs=('prefectures',),
+                  outputs=('prefectures_img', 'media_prefectures')),
+            Stage(partial(localize_images,
+                          itypes=('img_flag', 'img_seal', 'img_impression'),
+                          refresh=refresh),
+                  name='images_capitals', inputs=('capitals',),
+                  outputs=('capitals_img', 'media_capitals')),
+
+            Stage(partial(export_prefectures, outdir=outdir), name='export_prefectures',
+                  inputs=('prefectures_img',)),
+            Stage(partial(export_capitals, outdir=outdir), name='export_capitals',
+                  inputs=('capitals_img',)),
+        ]
+    else:
+        stages += [
+            Stage(partial(export_prefectures, outdir=outdir), name='export_prefectures',
+                  inputs=('prefectures',)),
+            Stage(partial(export_capitals, outdir=outdir), name='export_capitals',
+                  inputs=('capitals',)),
+        ]
+
+    return Pipeline(stages)
+###############################################################################
+
+
+################################################################################
+def build(targets=TARGETS, outdir=HERE, package='output.apkg', images=None,
+          refresh=False, incremental=False):
+    '''
+    Export the targets to `outdir` and write the package, return its path.
+
+    Images are shipped if the deck configuration asks for them by default.
+    With `incremental` the package is only written if a note or media file
+    changed since the last build, see core.buildstate.write_package().
+    '''
+
+    for kind in ('json', 'csv', 'tables'):
+        Path(outdir, kind).mkdir(parents=True, exist_ok=True)
+
+    # With images the prefecture media are produced along with their export
+    results = make_pipeline(
+        images=models_jp.IMAGES if images is None else images, refresh=refresh,
+        outdir=outdir).run([f'export_{target}' for target in targets])
+
+    notes = {target: results[target] for target in ('export_regions', 'export_prefectures')
+             if target in results}
+
+    # A regional deck only has the notes on its part of the map, the exports are complete
+    if models_jp.REGION:
+        notes = {target: region_notes(table, models_jp.REGION)
+                 for target, table in notes.items()}
+
+    media_files = models_jp.MEDIA_FILES + results.get('media_prefectures', [])
+
+    # The marked cards show a rendered map instead of the SVG
+    if models_jp.THUMBNAILS:
+        for target, prefix in (('export_regions', 'Region-'), ('export_prefectures', '')):
+            if target in notes:
+                notes[target], pngpaths = add_thumbnails(notes[target], prefix)
+                media_files += map(str, pngpaths)
+
+    tables = [(model, notes[target], None, 'tags', 'index')
+              for target, model in (('export_regions', models_jp.REG_MODEL),
+                                    ('export_prefectures', models_jp.PREF_MODEL))
+              if target in notes]
+
+    with profile.span('package'):
+        changed, removed = write_package(
+            package, models_jp.PREF_DECK, tables, media_files, incremental)
+
+    if incremental:
+        print(f'{package}: {len(changed)} notes new or changed, {len(removed)} removed')
+
+    return package
+
 
 ################################################################################
 def main():
@@ -417,28 +543,47 @@ def main():
     parser.add_argument('--prefs', action='store_true')
     parser.add_argument('--caps', action='store_true')
     parser.add_argument('--all', action='store_true')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use cached Wikidata results')
+    parser.add_argument('--cache-ttl', type=float, default=7 * 24,
+                        help='hours before cached results are revalidated')
+    parser.add_argument('--endpoint',
+                        help='SPARQL service URL, record:<dir> or replay:<dir>')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every replayed query')
+    parser.add_argument('--images', action='store_true',
+                        help='ship rasterized flags, symbols and pictures as media')
+    parser.add_argument('--refresh-images', action='store_true',
+                        help='revalidate the downloaded images, e.g. for upstream changes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only package again if notes changed, changes also to *.update.apkg')
+    parser.add_argument('--profile', type=Path, metavar='PATH',
+                        help='write a timing report (JSON, stacks in .folded) to PATH')
 
     args = parser.parse_args()
 
-    if args.regs:
-        process_regions()
+    profiler = profile.configure_profile(args.profile is not None)
+
+    configure_cache(ttl=args.cache_ttl * 3600, offline=args.offline)
+    configure_endpoint(args.endpoint, args.latency)
+
+    targets = []
+
+    if args.regs or args.all:
+        targets.append('regions')
 
-    if args.prefs:
-        process_prefectures()
+    if args.prefs or args.all:
+        targets.append('prefectures')
 
-    if args.caps:
-        process_capitals()
+    if args.caps or args.all:
+        targets.append('capitals')
 
-    if args.all:
-        # To get the statistics and indices of the regions right we need
-        # all the information from the prefectures first! This is written
-        # to a JSON file only, use preprocess to stop the Anki output!
-        process_prefectures(preprocess=True)
-        process_regions()
-        process_prefectures()  # Fix the indices according to the regions
-        process_capitals()
+    with profile.span('build'):
+        build(targets, images=args.images or None, refresh=args.refresh_images and not args.offline,
+              incremental=args.incremental)
 
-    genanki.Package(PREF_DECK).write_to_file('output.apkg')
+    if args.profile:
+        profiler.write(args.profile)
 
 if __name__ == '__main__':
     main()
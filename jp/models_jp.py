@@ -1,22 +1,29 @@
 '''
 A place for the models of the Anki deck.
-'''
 
-import json
+The configuration, the map, the CSS and the models are only read and built
+when first used, e.g. `models_jp.PREF_MODEL`, and kept per variant:
+
+    CONF, SHARED_MAP, MINIFY_MAP, QUERY_CHUNK_SIZE, TEMPLATES, REGION, THUMBNAILS, IMAGES
+    REGION_IDS, JP_SVG, CSS, MEDIA_FILES, PREF_DECK, REG_MODEL, PREF_MODEL
+'''
 
+from functools import lru_cache
 from pathlib import Path
 
 import genanki
 
-JP_SVG = Path('svg/MapJapan_final.svg').read_text()
-CSS = Path('layouts/common.css').read_text()
+from core.config import current_variant, load_config
+from core.maps import map_markup, map_media
+from core.templates import CardLayout, TemplateEngine
 
+HERE = Path(__file__).resolve().parent
 
-with Path('make_deck.json').open('r') as jsonfile:
-    CONF = json.load(jsonfile)
+JP_MAP = HERE / 'svg' / 'MapJapan_final.svg'
 
-################################################################################
-PREF_DECK = genanki.Deck(CONF['Deck']['deck_id'], CONF['Deck']['deck_name'])
+# What settings() provides, the rest is built by models()
+SETTINGS = ('CONF', 'SHARED_MAP', 'MINIFY_MAP', 'QUERY_CHUNK_SIZE', 'TEMPLATES', 'REGION',
+            'THUMBNAILS', 'IMAGES')
 
 
 CARD_TEMPLATE = '''
@@ -32,6 +39,9 @@ CARD_TEMPLATE = '''
         </div>
     </div>'''
 
+# The cards of all models and variants are rendered from one compiled template
+ENGINE = TemplateEngine(CARD_TEMPLATE)
+
 
 ################################################################################
 ################################################################################
@@ -79,42 +89,21 @@ REG_ANSWER = '''
     </div>'''
 
 ################################################################################
-REG_MODEL = genanki.Model(
-    CONF['Region Model']['model_id'],
-    CONF['Region Model']['model_name'],
-    fields=CONF['Region Model']['model_fields'],
-    templates=[
-        {
-            'name': 'Marked on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': REG_MARK_INPUT,
-                'answer': '',
-                'template': 'marked'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': REG_MARK_INPUT,
-                'answer': REG_ANSWER,
-                'template': 'marked'
-            }
-        },
-        {
-            'name': 'Click on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': REG_CLICK_INPUT_FRONT,
-                'answer': '',
-                'template': 'click'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': REG_CLICK_INPUT_BACK,
-                'answer': REG_ANSWER,
-                'template': 'click'
-            }
-        }],
-        css=CSS)
+REG_LAYOUTS = (
+    CardLayout('Marked on Map', 'marked', REG_MARK_INPUT, REG_MARK_INPUT, REG_ANSWER),
+    CardLayout('Click on Map', 'click',
+               REG_CLICK_INPUT_FRONT, REG_CLICK_INPUT_BACK, REG_ANSWER),
+)
+
+
+################################################################################
+def region_model(conf, svg, css):
+    '''
+    The model of the region notes.
+    '''
+
+    return ENGINE.model(conf['Region Model'], REG_LAYOUTS, svg, css,
+                        conf['Build']['templates'], conf['Build']['thumbnails'])
 
 
 ################################################################################
@@ -160,39 +149,86 @@ PREF_ANSWER = '''
     </div>'''
 
 ################################################################################
-PREF_MODEL = genanki.Model(
-    CONF['Prefecture Model']['model_id'],
-    CONF['Prefecture Model']['model_name'],
-    fields=CONF['Prefecture Model']['model_fields'],
-    templates=[
-        {
-            'name': 'Marked on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': PREF_MARK_INPUT,
-                'answer': '',
-                'template': 'marked'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': PREF_MARK_INPUT,
-                'answer': PREF_ANSWER,
-                'template': 'marked'
-            }
-        },
-        {
-            'name': 'Click on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': PREF_CLICK_INPUT_FRONT,
-                'answer': '',
-                'template': 'click'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': JP_SVG,
-                'input': PREF_CLICK_INPUT_BACK,
-                'answer': PREF_ANSWER,
-                'template': 'click'
-            }
-        }],
-    css=CSS)
+PREF_LAYOUTS = (
+    CardLayout('Marked on Map', 'marked', PREF_MARK_INPUT, PREF_MARK_INPUT, PREF_ANSWER),
+    CardLayout('Click on Map', 'click',
+               PREF_CLICK_INPUT_FRONT, PREF_CLICK_INPUT_BACK, PREF_ANSWER),
+)
+
+
+################################################################################
+def prefecture_model(conf, svg, css):
+    '''
+    The model of the prefecture notes.
+    '''
+
+    return ENGINE.model(conf['Prefecture Model'], PREF_LAYOUTS, svg, css,
+                        conf['Build']['templates'], conf['Build']['thumbnails'])
+
+
+################################################################################
+@lru_cache(maxsize=None)
+def settings(variant=None):
+    '''
+    The build settings of the configuration of a variant.
+    '''
+
+    conf = load_config(HERE / 'make_deck_jp.json', variant)
+
+    return {
+        'CONF': conf,
+        # Ship the map once as media instead of inlining it into every template
+        'SHARED_MAP': conf['Build']['shared_map'],
+        'MINIFY_MAP': conf['Build']['minify_map'],
+        # Fetch the query results in pages of this many rows, all at once if null
+        'QUERY_CHUNK_SIZE': conf['Build']['query_chunk_size'],
+        # The names of the card templates to build, all if null
+        'TEMPLATES': conf['Build']['templates'],
+        # Show pre-rendered maps with the map IDs marked on the marked cards
+        'THUMBNAILS': conf['Build']['thumbnails'],
+        # Only the notes and the part of the map of this region (its map ID), all if null
+        'REGION': conf['Build']['region'],
+        # Ship rasterized flags and symbols as media, also with --images
+        'IMAGES': conf['Build']['images'],
+    }
+
+
+################################################################################
+@lru_cache(maxsize=None)
+def models(variant=None):
+    '''
+    The assets, deck and models of a variant.
+    '''
+
+    conf = settings(variant)
+    ids = [f'Region-{conf["REGION"]}'] if conf['REGION'] else None
+
+    svg = map_markup(JP_MAP, conf['SHARED_MAP'], conf['MINIFY_MAP'], ids)
+    css = (HERE / 'layouts' / 'common.css').read_text()
+
+    return {
+        # The IDs the map is cut to, None for the whole map
+        'REGION_IDS': ids,
+        'JP_SVG': svg,
+        'CSS': css,
+        'MEDIA_FILES': ([map_media(JP_MAP, conf['MINIFY_MAP'], ids)]
+                        if conf['SHARED_MAP'] else []),
+        'PREF_DECK': genanki.Deck(conf['CONF']['Deck']['deck_id'],
+                                  conf['CONF']['Deck']['deck_name']),
+        'REG_MODEL': region_model(conf['CONF'], svg, css),
+        'PREF_MODEL': prefecture_model(conf['CONF'], svg, css),
+    }
+
+
+################################################################################
+def __getattr__(name):
+    '''
+    Build the settings and models on first use, for the selected variant.
+    '''
+
+    registry = settings if name in SETTINGS else models
+
+    try:
+        return registry(current_variant())[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
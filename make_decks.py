@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+
+'''
+Build several decks, or variants of them, in parallel worker processes.
+
+    python make_decks.py jp jp:click us --outdir build --jobs 3
+
+Every deck is built in a worker process of its own, which builds the models
+of the deck for its variant on first use. Each build writes its exports and
+package to `<outdir>/<deck>[-<variant>]/`, the Wikidata and image caches are
+shared by all of them.
+'''
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from core import profile
+from core.config import load_config, select_variant
+from core.wikidata import configure_cache, configure_endpoint
+
+ROOT = Path(__file__).resolve().parent
+
+# The builder module and the configuration of every deck
+DECKS = {
+    'jp': ('jp.make_deck_jp', 'jp/make_deck_jp.json'),
+    'us': ('us.create_anki', 'us/make_deck_us.json'),
+}
+
+
+################################################################################
+def parse_spec(spec):
+    '''
+    Split `deck[:variant]` and check that the deck has that variant.
+    '''
+
+    deck, _, variant = spec.partition(':')
+
+    if deck not in DECKS:
+        raise ValueError(f'Unknown deck {deck}, use one of {", ".join(DECKS)}')
+
+    # Raises for an unknown variant
+    load_config(ROOT / DECKS[deck][1], variant or None)
+
+    return deck, variant or None
+
+
+################################################################################
+def build_deck(spec, outdir, offline=False, cache_ttl=7 * 24, endpoint=None,
+               latency=0.0, profiling=False, incremental=False, refresh_images=False):
+    '''
+    Build one deck in a worker process, return its package and the seconds taken.
+
+    With `profiling` a timing report is written to profile.json in the deck's
+    directory, `incremental` only packages decks with changed notes again.
+    Downloaded images are only revalidated with `refresh_images`.
+    '''
+
+    start = time.perf_counter()
+
+    deck, variant = parse_spec(spec)
+
+    select_variant(variant)
+    profiler = profile.configure_profile(profiling)
+    configure_cache(ttl=cache_ttl * 3600, offline=offline)
+    configure_endpoint(endpoint, latency)
+
+    builder = importlib.import_module(DECKS[deck][0])
+
+    deckdir = Path(outdir).resolve() / (f'{deck}-{variant}' if variant else deck)
+
+    with profile.span('build'):
+        package = builder.build(outdir=str(deckdir),
+                                package=str(deckdir / f'{deckdir.name}.apkg'),
+                                refresh=refresh_images and not offline,
+                                incremental=incremental)
+
+    if profiling:
+        profiler.write(deckdir / 'profile.json')
+
+    return package, time.perf_counter() - start
+
+
+################################################################################
+def list_decks():
+    '''
+    Print the decks and their variants.
+    '''
+
+    for deck, (_, config) in DECKS.items():
+        variants = json.loads((ROOT / config).read_text()).get('Variants', {})
+        variants = ', '.join(f'{deck}:{variant}' for variant in variants)
+
+        print(f'{deck}{": " + variants if variants else ""}')
+
+
+################################################################################
+def main():
+    '''Build decks and their variants in parallel.'''
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+
+    parser.add_argument('decks', nargs='*', metavar='deck[:variant]',
+                        help='the decks to build, all default decks if none')
+    parser.add_argument('--list', action='store_true',
+                        help='list the decks and their variants')
+    parser.add_argument('--outdir', type=Path, default=Path('build'),
+                        help='one directory per deck is created in here')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='decks built at the same time')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use cached Wikidata results')
+    parser.add_argument('--cache-ttl', type=float, default=7 * 24,
+                        help='hours before cached results are revalidated')
+    parser.add_argument('--endpoint',
+                        help='SPARQL service URL, record:<dir> or replay:<dir>')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every replayed query')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only package again if notes changed, changes also to *.update.apkg')
+    parser.add_argument('--profile', action='store_true',
+                        help='write a timing report to profile.json for every deck')
+    parser.add_argument('--refresh-images', action='store_true',
+                        help='revalidate the downloaded images, e.g. for upstream changes')
+
+    args = parser.parse_args()
+
+    if args.list:
+        list_decks()
+        return
+
+    specs = list(dict.fromkeys(args.decks or DECKS))
+
+    for spec in specs:
+        try:
+            parse_spec(spec)
+        except ValueError as err:
+            parser.error(str(err))
+
+    # Fresh interpreters, a deck's models must not be shared between variants
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(specs)),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             max_tasks_per_child=1) as executor:
+        futures = {
+            executor.submit(build_deck, spec, args.outdir, args.offline,
+                            args.cache_ttl, args.endpoint, args.latency,
+                            args.profile, args.incremental, args.refresh_images): spec
+            for spec in specs}
+
+        failed = []
+
+        for future in as_completed(futures):
+            spec = futures[future]
+
+            try:
+                package, seconds = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                failed.append(spec)
+                print(f'{spec}: failed, {type(err).__name__}: {err}')
+            else:
+                print(f'{spec}: {package} ({seconds:.1f}s)')
+
+    if failed:
+        raise SystemExit(f'{len(failed)} of {len(specs)} decks failed: {", ".join(failed)}')
+
+
+################################################################################
+if __name__ == '__main__':
+    main()
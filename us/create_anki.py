@@ -2,82 +2,107 @@
 Create an Anki deck from Wikidata results.
 """
 
+import argparse
+
 from pathlib import Path
-from urllib.parse import urlparse
 
-import genanki as anki
-import numpy as np
 import pandas as pd
-import requests as rq
-
-from wand.api import library as wandlib
-import wand.color
-import wand.image
 
-from core.wikidata import WDQuery
+from core import profile
+from core.buildstate import write_package
+from core.geometry import map_index
+from core.images import image_jobs, img_tag
+from core.images import prepare_images as prepare_images_batch
+from core.names import NameNormalizer
+from core.maps import map_thumbnails
+from core.ranking import rank_frame
+from core.templates import THUMBNAIL_FIELD
+from core.wikidata import WDQuery, configure_cache, configure_endpoint
+from us import models
 from us.data import US_REGIONS
-from us.models import STATE_DECK, STATE_MODEL, STATE_FIELDS, REG_MODEL
+
+# The files of the deck are next to this module, wherever it is run from
+HERE = Path(__file__).resolve().parent
+
+# Spaces in the map IDs become underscores, the names are not shortened
+MAP_IDS = NameNormalizer(suffixes=None, map_id=str.maketrans(" ", "_"), romaji=None)
+
+# The levels the states are aggregated to as (column prefix, grouping column)
+REGION_LEVELS = (
+    ("reg", "reg_name_en"),
+    ("census", "reg_census_region"),
+    ("country", "country"),
+)
 
 
 ########################################################################################
 def name_to_id(name):
     """Fix strings so that they can be used as IDs everywhere."""
 
-    return name.replace(" ", "_")
+    return MAP_IDS.map_id(name)
 
 
 ########################################################################################
-def prepare_images(wd_s, itype="flag"):
+def prepare_images(wd_df, itypes=("flag", "seal"), refresh=False):
     """
     Get all SVG images referenced in Wikidata and convert them to PNGs.
-    """
-
-    ####################################################################################
-    def convert_img(state, itype, url):
-        if not url:
-            return None
 
-        svgpath = Path("us/img/svg") / Path(urlparse(url).path).name
-        pngpath = Path("us/img/png") / f"{name_to_id(state)}_{itype}.png"
-
-        if not svgpath.is_file():
-            svgblob = rq.get(url).content
+    With `refresh`, the SVGs are revalidated against Wikimedia Commons.
+    """
 
-            with svgpath.open("wb") as outfile:
-                outfile.write(svgblob)
+    jobs = {}
 
-        if pngpath.is_file():
-            return pngpath
+    for itype in itypes:
+        urls = wd_df[f"svg_{itype}"]
 
-        with wand.image.Image() as image:
-            with wand.color.Color("transparent") as background_color:
-                wandlib.MagickSetBackgroundColor(image.wand, background_color.resource)
+        # The seal is what we want for the symbol/seal, if it is not present
+        # we replace it with the content from svg_symbol.
+        if itype == "seal":
+            urls = urls.where(urls.notna() & (urls != ""), wd_df.svg_symbol)
 
-            image.read(blob=svgpath.read_bytes())
-            image.transform(resize="x128")
+        valid = urls.notna() & (urls != "")
 
-            with pngpath.open("wb") as outfile:
-                outfile.write(image.make_blob("png32"))
+        jobs[itype] = dict(
+            zip(
+                urls.index[valid],
+                image_jobs(
+                    zip(wd_df.name_en[valid], urls[valid]),
+                    itype,
+                    HERE / "img" / "svg",
+                    HERE / "img" / "png",
+                ),
+            )
+        )
 
-        return pngpath
+    # Download and rasterize the images of all types in one go
+    prepare_images_batch(
+        (job for itype_jobs in jobs.values() for job in itype_jobs.values()),
+        refresh=refresh,
+    )
 
-    # The seal is what we want for the symbol/seal, if it is not present
-    # we replace it with the content from svg_symbol.
-    conv_type = "symbol" if itype == "seal" and not wd_s.svg_seal else itype
+    for itype, itype_jobs in jobs.items():
+        pngpaths = [
+            itype_jobs[idx].pngpath if idx in itype_jobs else None
+            for idx in wd_df.index
+        ]
 
-    pngpath = convert_img(wd_s.name_en, itype, wd_s[f"svg_{conv_type}"])
-    imgtag = f'<img src="{pngpath.name}" height="128px">' if pngpath else None
+        wd_df[f"pngpath_{itype}"] = pngpaths
+        wd_df[f"img_{itype}"] = [img_tag(path) if path else None for path in pngpaths]
 
-    return pngpath, imgtag
+    return wd_df
 
 
 ########################################################################################
-def prepare_anki(wd_df):
+def prepare_anki(wd_df, package="output_us.apkg", incremental=False, check=True):
     """
-    Take the pre-processed information and dump it to the Anki format.
+    Take the pre-processed information and dump it to the Anki `package`.
+
+    With `incremental` the package is only written if a note or media file
+    changed, see core.buildstate.write_package(). With `check` all map IDs
+    have to be on the maps.
     """
 
-    media_files = []
+    media_files = list(models.MEDIA_FILES)
 
     for name in ("flag", "seal"):
         media_files.extend(map(str, wd_df[f"pngpath_{name}"].dropna().tolist()))
@@ -90,49 +115,71 @@ def prepare_anki(wd_df):
 
     wd_df = wd_df.sort_values(by="idx")
 
-    for _, reg_group in wd_df.groupby("reg_name_en", sort=False):
-        reg_data = {
-            "idx": str(100 * reg_group.iloc[0]["reg_stats_population_rank"]),
-            "title": reg_group.iloc[0]["reg_name_en"],
-            "name_en": ", ".join(reg_group.iloc[0]["aliases"]),
-            "contained_states": ", ".join(reg_group.loc[:, "name_en"]),
-            "map_ids": name_to_id(reg_group.iloc[0]["reg_name_en"]),
-            "stats_population": str(reg_group.iloc[0]["reg_stats_population"]),
-            "stats_population_density": f'{reg_group.iloc[0]["reg_stats_population_density"]:.2f}',
-            "stats_population_rank": str(
-                reg_group.iloc[0]["reg_stats_population_rank"]
+    # A regional deck only has the notes on its part of the map
+    if models.REGION:
+        wd_df = wd_df[wd_df.reg_name_en == models.REGION]
+
+    # One row per region, in the order of the regions' ranks
+    reg_df = wd_df.drop_duplicates("reg_name_en")
+    contained_states = wd_df.groupby("reg_name_en", sort=False).name_en.agg(", ".join)
+
+    reg_notes = pd.DataFrame(
+        {
+            "idx": (100 * reg_df.reg_stats_population_rank).astype(str),
+            "title": reg_df.reg_name_en,
+            "name_en": reg_df.aliases.map(", ".join),
+            "contained_states": reg_df.reg_name_en.map(contained_states),
+            "map_ids": reg_df.reg_name_en.map(name_to_id),
+            "stats_population": reg_df.reg_stats_population,
+            "stats_population_density": reg_df.reg_stats_population_density.map(
+                "{:.2f}".format
             ),
-            "stats_area": reg_group.iloc[0]["reg_stats_area"],
-            "stats_area_rank": str(reg_group.iloc[0]["reg_stats_area_rank"]),
-            "url_wikipedia": reg_group.iloc[0]["reg_url_wikipedia"],
+            "stats_population_rank": reg_df.reg_stats_population_rank.astype(str),
+            "stats_area": reg_df.reg_stats_area,
+            "stats_area_rank": reg_df.reg_stats_area_rank.astype(str),
+            "url_wikipedia": reg_df.reg_url_wikipedia,
         }
-        print(reg_data.values())
-
-        STATE_DECK.add_note(
-            anki.Note(
-                model=REG_MODEL,
-                fields=list(reg_data.values()),
-                sort_field="title",
-                tags=["region"],
-                guid=reg_data["idx"],
-            )
-        )
+    )
 
-        for row_idx, row in reg_group.iterrows():
-            print(row.loc[STATE_FIELDS].to_list())
-            STATE_DECK.add_note(
-                anki.Note(
-                    model=STATE_MODEL,
-                    fields=list(map(str, row.loc[STATE_FIELDS].to_list())),
-                    sort_field="title",
-                    tags=["state"],
-                    guid=row_idx,
-                )
+    # Every map ID of the notes has to be on the map they are shown on
+    if check:
+        map_index(models.REGS_MAP).check(reg_notes.map_ids)
+        map_index(models.STATES_MAP).check(wd_df.map_ids)
+
+    # The marked cards show a rendered map instead of the SVG
+    if models.THUMBNAILS:
+        for notes, names, svg_path in (
+            (reg_notes, reg_notes.title, models.REGS_MAP),
+            (wd_df, wd_df.name_en, models.STATES_MAP),
+        ):
+            pngpaths = map_thumbnails(
+                zip(names, notes.map_ids),
+                svg_path,
+                HERE / "img" / "thumbnails",
+                models.MINIFY_MAP,
+                models.REGION_IDS,
             )
 
-    pkg = anki.Package(STATE_DECK)
-    pkg.media_files = media_files
-    pkg.write_to_file("output_us.apkg")
+            notes[THUMBNAIL_FIELD] = [img_tag(path, 360) for path in pngpaths]
+            media_files.extend(map(str, pngpaths))
+
+    tables = [
+        (models.REG_MODEL, reg_notes, None, ("region",), "idx"),
+        (
+            models.STATE_MODEL,
+            wd_df.assign(guid=wd_df.index),
+            models.STATE_FIELDS,
+            ("state",),
+            "guid",
+        ),
+    ]
+
+    changed, removed = write_package(
+        package, models.STATE_DECK, tables, media_files, incremental
+    )
+
+    if incremental:
+        print(f"{package}: {len(changed)} notes new or changed, {len(removed)} removed")
 
 
 ########################################################################################
@@ -150,95 +197,149 @@ def prepare_states(wd_df):
 
     wd_df = wd_df.assign(stats_population_density=pop_dens.apply(lambda x: f"{x:.2f}"))
 
-    wd_df = wd_df.sort_values(by="stats_population", ascending=False, ignore_index=True)
+    wd_df = rank_frame(wd_df, ["stats_population", "stats_area"])
 
-    wd_df = wd_df.assign(stats_population_rank=wd_df.index + 1)
-
-    area_index = wd_df.sort_values(by="stats_area", ascending=False).index
-    wd_df.loc[area_index, "stats_area_rank"] = range(1, len(area_index) + 1)
+    # The regions number their states in this order
+    wd_df = wd_df.sort_values(by="stats_population_rank", ignore_index=True)
 
     return wd_df
 
 
 ########################################################################################
-def prepare_regions(wd_df):
+def aggregate_level(wd_df, key, prefix, columns=("stats_population", "stats_area")):
+    """
+    Sum the stats per group of `key` in one pass and rank the groups.
+
+    The totals, the population density and the ranks of each group are joined
+    to all of its rows as `<prefix>_<column>`.
+    """
+
+    totals = wd_df.groupby(key, sort=False)[list(columns)].agg("sum")
+    totals = totals.assign(
+        stats_population_density=totals.stats_population / totals.stats_area
+    )
+    totals = rank_frame(totals, columns)
+
+    return wd_df.join(totals.add_prefix(f"{prefix}_"), on=key)
+
+
+########################################################################################
+def prepare_regions(wd_df, levels=REGION_LEVELS, regions=US_REGIONS):
     """
     Format the manual region information into expected format.
+
+    The states are aggregated to every level in `levels`, e.g. the divisions
+    (`reg_*`), the census regions (`census_*`) and the whole country.
     """
 
-    regions = pd.DataFrame(US_REGIONS)
+    regions = pd.DataFrame(regions)
     regions = regions.explode("reg_state_list")
 
     wd_df = wd_df.join(regions.set_index("reg_state_list"), on="name_en")
+    wd_df = wd_df.assign(country="United States")
 
-    wd_df = wd_df.assign(reg_stats_population=None, reg_stats_area=None)
+    for prefix, key in levels:
+        wd_df = aggregate_level(wd_df, key, prefix)
 
-    for reg_indices in wd_df.groupby("reg_name_en").groups.values():
-        wd_df.loc[reg_indices, "reg_stats_population"] = wd_df.loc[
-            reg_indices, "stats_population"
-        ].sum()
+    # Index the cards according to their region and population rank, keep
+    # the even numbers for the capitals if necessary
+    wd_df["idx"] = (
+        100 * wd_df.reg_stats_population_rank
+        + 2 * wd_df.groupby("reg_name_en").cumcount()
+        + 1
+    )
 
-        wd_df.loc[reg_indices, "reg_stats_area"] = wd_df.loc[
-            reg_indices, "stats_area"
-        ].sum()
+    return wd_df.astype(
+        {"idx": int, "reg_stats_population_rank": int, "reg_stats_area_rank": int}
+    )
 
-        wd_df.loc[reg_indices, "reg_stats_population_density"] = (
-            wd_df.loc[reg_indices, "reg_stats_population"]
-            / wd_df.loc[reg_indices, "reg_stats_area"]
-        )
 
-    regions = wd_df.groupby("reg_name_en")
+########################################################################################
+def build(outdir=".", package="output_us.apkg", refresh=False, incremental=False):
+    """
+    Query, process and package the states, return the path of the package.
 
-    pop_indices = (
-        regions.sum().sort_values(by="stats_population", ascending=False).index
-    )
+    The deck has no exports besides the package, `outdir` is only created.
+    """
 
-    for rank, pop_index in enumerate(pop_indices, 1):
-        reg_index = regions.indices[pop_index]
+    Path(outdir).mkdir(parents=True, exist_ok=True)
 
-        wd_df.loc[reg_index, "reg_stats_population_rank"] = rank
+    states_rq = (HERE / "sparql" / "states.rq").read_text()
 
-        # Index the cards according to their region and population rank, keep
-        # the even numbers for the capitals if necessary
-        wd_df.loc[reg_index, "idx"] = 100 * rank + 2 * np.arange(len(reg_index)) + 1
+    with profile.span("query_states"):
+        wd_df = WDQuery(states_rq, chunk_size=models.QUERY_CHUNK_SIZE).get_df()
 
-    area_indices = regions.sum().sort_values(by="stats_area", ascending=False).index
+    with profile.span("prepare_states"):
+        wd_df = prepare_states(wd_df)
 
-    for rank, area_index in enumerate(area_indices, 1):
-        wd_df.loc[regions.indices[area_index], "reg_stats_area_rank"] = rank
+    with profile.span("prepare_images"):
+        wd_df = prepare_images(wd_df, refresh=refresh)
 
-    wd_df = wd_df.astype(
-        {"idx": int, "reg_stats_population_rank": int, "reg_stats_area_rank": int}
-    )
+    with profile.span("prepare_regions"):
+        wd_df = prepare_regions(wd_df)
 
-    return wd_df
+    with profile.span("package"):
+        prepare_anki(wd_df, package, incremental)
+
+    return package
 
 
 ########################################################################################
 def main():
     """Main."""
 
-    df_pickle_path = Path("us/jar/wd_df.bz2")
+    parser = argparse.ArgumentParser()
 
-    if not df_pickle_path.is_file():
-        print("Pickled query does not exist, querying WikiData ...")
+    parser.add_argument(
+        "--offline", action="store_true", help="only use cached Wikidata results"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=7 * 24,
+        help="hours before cached results are revalidated",
+    )
+    parser.add_argument(
+        "--endpoint", help="SPARQL service URL, record:<dir> or replay:<dir>"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds added to every replayed query",
+    )
+    parser.add_argument(
+        "--refresh-images",
+        action="store_true",
+        help="revalidate the downloaded images, e.g. for upstream changes",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only package again if notes changed, changes also to *.update.apkg",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="PATH",
+        help="write a timing report (JSON, stacks in .folded) to PATH",
+    )
 
-        states_rq = Path("us/sparql/states.rq").read_text()
+    args = parser.parse_args()
 
-        wdq = WDQuery(states_rq)
-        wdq.get_df().to_pickle(df_pickle_path)
+    profiler = profile.configure_profile(args.profile is not None)
 
-    wd_df = pd.read_pickle(df_pickle_path)
-    wd_df = prepare_states(wd_df)
+    configure_cache(ttl=args.cache_ttl * 3600, offline=args.offline)
+    configure_endpoint(args.endpoint, args.latency)
 
-    for itype in ("flag", "seal"):
-        wd_df[[f"pngpath_{itype}", f"img_{itype}"]] = wd_df.apply(
-            prepare_images, axis=1, result_type="expand", args=(itype,)
+    with profile.span("build"):
+        build(
+            refresh=args.refresh_images and not args.offline,
+            incremental=args.incremental,
         )
 
-    wd_df = prepare_regions(wd_df)
-
-    prepare_anki(wd_df)
+    if args.profile:
+        profiler.write(args.profile)
 
 
 ########################################################################################
@@ -1,27 +1,32 @@
 '''
 A place for the models of the US Anki deck.
-'''
 
-import json
+The configuration, the maps, the CSS and the models are only read and built
+when first used, e.g. `models.STATE_MODEL`, and kept per variant:
+
+    CONF, SHARED_MAP, MINIFY_MAP, QUERY_CHUNK_SIZE, TEMPLATES, REGION, THUMBNAILS,
+    STATE_FIELDS, REG_FIELDS
+    REGION_IDS, SVG_STATES, SVG_REGS, CSS, MEDIA_FILES, STATE_DECK, REG_MODEL, STATE_MODEL
+'''
 
+from functools import lru_cache
 from pathlib import Path
 from operator import itemgetter
 
 import genanki as anki
 
+from core.config import current_variant, load_config
+from core.maps import map_markup, map_media
+from core.templates import THUMBNAIL_FIELD, CardLayout, TemplateEngine
 
-################################################################################
-SVG_STATES = Path('us/svg/MapUS1.svg').read_text()
-SVG_REGS = Path('us/svg/MapUS1_reg.svg').read_text()
-CSS = Path('us/templates/common.css').read_text()
-CONF = json.loads(Path('us/make_deck_us.json').read_text())
-
+HERE = Path(__file__).resolve().parent
 
-################################################################################
-STATE_DECK = anki.Deck(CONF['Deck']['deck_id'], CONF['Deck']['deck_name'])
+STATES_MAP = HERE / 'svg' / 'MapUS1.svg'
+REGS_MAP = HERE / 'svg' / 'MapUS1_reg.svg'
 
-STATE_FIELDS = list(map(itemgetter('name'), CONF['State Model']['model_fields']))
-REG_FIELDS = list(map(itemgetter('name'), CONF['Region Model']['model_fields']))
+# What settings() provides, the rest is built by models()
+SETTINGS = ('CONF', 'SHARED_MAP', 'MINIFY_MAP', 'QUERY_CHUNK_SIZE', 'TEMPLATES', 'REGION',
+            'THUMBNAILS', 'STATE_FIELDS', 'REG_FIELDS')
 
 
 CARD_TEMPLATE = '''
@@ -37,6 +42,9 @@ CARD_TEMPLATE = '''
         </div>
     </div>'''
 
+# The cards of all models and variants are rendered from one compiled template
+ENGINE = TemplateEngine(CARD_TEMPLATE)
+
 
 ################################################################################
 ################################################################################
@@ -93,42 +101,21 @@ REG_ANSWER = '''
 
 
 ################################################################################
-REG_MODEL = anki.Model(
-    CONF['Region Model']['model_id'],
-    CONF['Region Model']['model_name'],
-    fields=CONF['Region Model']['model_fields'],
-    templates=[
-        {
-            'name': 'Marked on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': SVG_REGS,
-                'input': REG_MARK_INPUT,
-                'answer': '',
-                'template': 'marked'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': SVG_REGS,
-                'input': REG_MARK_INPUT,
-                'answer': REG_ANSWER,
-                'template': 'marked'
-            }
-        },
-        {
-            'name': 'Click on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': SVG_REGS,
-                'input': REG_CLICK_INPUT_FRONT,
-                'answer': '',
-                'template': 'click'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': SVG_REGS,
-                'input': REG_CLICK_INPUT_BACK,
-                'answer': REG_ANSWER,
-                'template': 'click'
-            }
-        }],
-        css=CSS)
+REG_LAYOUTS = (
+    CardLayout('Marked on Map', 'marked', REG_MARK_INPUT, REG_MARK_INPUT, REG_ANSWER),
+    CardLayout('Click on Map', 'click',
+               REG_CLICK_INPUT_FRONT, REG_CLICK_INPUT_BACK, REG_ANSWER),
+)
+
+
+################################################################################
+def region_model(conf, svg, css):
+    '''
+    The model of the region notes.
+    '''
+
+    return ENGINE.model(conf['Region Model'], REG_LAYOUTS, svg, css,
+                        conf['Build']['templates'], conf['Build']['thumbnails'])
 
 
 ################################################################################
@@ -185,39 +172,92 @@ STATE_ANSWER = '''
     </div>'''
 
 ################################################################################
-STATE_MODEL = anki.Model(
-    CONF['State Model']['model_id'],
-    CONF['State Model']['model_name'],
-    fields=CONF['State Model']['model_fields'],
-    templates=[
-        {
-            'name': 'Marked on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': SVG_STATES,
-                'input': STATE_MARK_INPUT,
-                'answer': '',
-                'template': 'marked'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': SVG_STATES,
-                'input': STATE_MARK_INPUT,
-                'answer': STATE_ANSWER,
-                'template': 'marked'
-            }
-        },
-        {
-            'name': 'Click on Map',
-            'qfmt': CARD_TEMPLATE % {
-                'svg': SVG_STATES,
-                'input': STATE_CLICK_INPUT_FRONT,
-                'answer': '',
-                'template': 'click'
-            },
-            'afmt': CARD_TEMPLATE % {
-                'svg': SVG_STATES,
-                'input': STATE_CLICK_INPUT_BACK,
-                'answer': STATE_ANSWER,
-                'template': 'click'
-            }
-        }],
-    css=CSS)
+STATE_LAYOUTS = (
+    CardLayout('Marked on Map', 'marked', STATE_MARK_INPUT, STATE_MARK_INPUT, STATE_ANSWER),
+    CardLayout('Click on Map', 'click',
+               STATE_CLICK_INPUT_FRONT, STATE_CLICK_INPUT_BACK, STATE_ANSWER),
+)
+
+
+################################################################################
+def state_model(conf, svg, css):
+    '''
+    The model of the state notes.
+    '''
+
+    return ENGINE.model(conf['State Model'], STATE_LAYOUTS, svg, css,
+                        conf['Build']['templates'], conf['Build']['thumbnails'])
+
+
+################################################################################
+@lru_cache(maxsize=None)
+def settings(variant=None):
+    '''
+    The build settings of the configuration of a variant.
+    '''
+
+    conf = load_config(HERE / 'make_deck_us.json', variant)
+
+    return {
+        'CONF': conf,
+        # Ship the maps once as media instead of inlining them into every template
+        'SHARED_MAP': conf['Build']['shared_map'],
+        'MINIFY_MAP': conf['Build']['minify_map'],
+        # Fetch the query results in pages of this many rows, all at once if null
+        'QUERY_CHUNK_SIZE': conf['Build']['query_chunk_size'],
+        # The names of the card templates to build, all if null
+        'TEMPLATES': conf['Build']['templates'],
+        # Show pre-rendered maps with the map IDs marked on the marked cards
+        'THUMBNAILS': conf['Build']['thumbnails'],
+        # Only the notes and the part of the maps of this region (its name), all if null
+        'REGION': conf['Build']['region'],
+        'STATE_FIELDS': (list(map(itemgetter('name'), conf['State Model']['model_fields']))
+                         + ([THUMBNAIL_FIELD] if conf['Build']['thumbnails'] else [])),
+        'REG_FIELDS': (list(map(itemgetter('name'), conf['Region Model']['model_fields']))
+                       + ([THUMBNAIL_FIELD] if conf['Build']['thumbnails'] else [])),
+    }
+
+
+################################################################################
+@lru_cache(maxsize=None)
+def models(variant=None):
+    '''
+    The assets, deck and models of a variant.
+    '''
+
+    conf = settings(variant)
+    # Both maps group the states by region, the group IDs are the names with underscores
+    ids = [conf['REGION'].replace(' ', '_')] if conf['REGION'] else None
+
+    svg_states = map_markup(STATES_MAP, conf['SHARED_MAP'], conf['MINIFY_MAP'], ids)
+    svg_regs = map_markup(REGS_MAP, conf['SHARED_MAP'], conf['MINIFY_MAP'], ids)
+    css = (HERE / 'templates' / 'common.css').read_text()
+
+    return {
+        # The IDs the maps are cut to, None for the whole maps
+        'REGION_IDS': ids,
+        'SVG_STATES': svg_states,
+        'SVG_REGS': svg_regs,
+        'CSS': css,
+        'MEDIA_FILES': ([map_media(STATES_MAP, conf['MINIFY_MAP'], ids),
+                         map_media(REGS_MAP, conf['MINIFY_MAP'], ids)]
+                        if conf['SHARED_MAP'] else []),
+        'STATE_DECK': anki.Deck(conf['CONF']['Deck']['deck_id'],
+                                conf['CONF']['Deck']['deck_name']),
+        'REG_MODEL': region_model(conf['CONF'], svg_regs, css),
+        'STATE_MODEL': state_model(conf['CONF'], svg_states, css),
+    }
+
+
+################################################################################
+def __getattr__(name):
+    '''
+    Build the settings and models on first use, for the selected variant.
+    '''
+
+    registry = settings if name in SETTINGS else models
+
+    try:
+        return registry(current_variant())[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None